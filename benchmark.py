@@ -0,0 +1,381 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from src.scheduler import percentile
+
+# tokens of the stand-in vocabulary, enough for the invoice schema tags
+_SPECIAL_TOKENS = ["<pad>", "<s>", "</s>", "<unk>", "<s_cord-v2>"]
+_TAGS = [
+    f"<{prefix}{name}>"
+    for name in (
+        "s_header", "s_items", "s_summary", "s_invoice_no", "s_invoice_date",
+        "s_seller", "s_client", "s_item_desc", "s_item_qty", "s_total_gross_worth",
+    )
+    for prefix in ("", "/")
+]
+
+
+def build_tokenizer():
+    """Small word level tokenizer, built in memory so nothing is downloaded."""
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    words = [str(i) for i in range(100)] + ["SELECT", "FROM", "WHERE", "header", "items", "summary"]
+    vocab = {token: idx for idx, token in enumerate(_SPECIAL_TOKENS + _TAGS + words)}
+
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+    )
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<s_cord-v2>"] + _TAGS})
+    return tokenizer
+
+
+def build_tiny_donut(folder: str, seed: int = 0) -> str:
+    """Saves a randomly initialised Donut-shaped model and processor to `folder`."""
+    import torch
+    from transformers import (
+        DonutImageProcessor,
+        DonutProcessor,
+        DonutSwinConfig,
+        DonutSwinModel,
+        MBartConfig,
+        MBartForCausalLM,
+        VisionEncoderDecoderModel,
+    )
+
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer()
+
+    image_processor = DonutImageProcessor(size={"height": 160, "width": 128})
+    processor = DonutProcessor(image_processor=image_processor, tokenizer=tokenizer)
+
+    encoder = DonutSwinModel(
+        DonutSwinConfig(
+            image_size=[160, 128],
+            patch_size=4,
+            embed_dim=16,
+            depths=[1, 1],
+            num_heads=[1, 2],
+            window_size=4,
+        )
+    )
+    decoder = MBartForCausalLM(
+        MBartConfig(
+            vocab_size=len(tokenizer),
+            d_model=32,
+            decoder_layers=1,
+            decoder_attention_heads=2,
+            decoder_ffn_dim=64,
+            max_position_embeddings=64,
+            is_decoder=True,
+            add_cross_attention=True,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+    )
+    model = VisionEncoderDecoderModel(encoder=encoder, decoder=decoder)
+    model.config.decoder_start_token_id = tokenizer.convert_tokens_to_ids("<s_cord-v2>")
+    model.config.pad_token_id = tokenizer.pad_token_id
+
+    processor.save_pretrained(folder)
+    model.save_pretrained(folder)
+    return folder
+
+
+def build_tiny_causal_lm(folder: str, seed: int = 0) -> str:
+    """Saves a randomly initialised causal LM standing in for nsql-350M."""
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer()
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            vocab_size=len(tokenizer),
+            n_positions=2048,
+            n_embd=32,
+            n_layer=2,
+            n_head=2,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+    )
+
+    tokenizer.save_pretrained(folder)
+    model.save_pretrained(folder)
+    return folder
+
+
+def latency_summary(latencies: list) -> dict:
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def bench_extraction(model_dir: str, image_dir: str, batch_sizes: list, limit: int) -> dict:
+    """Images/sec and per-batch latency of `DonutInference.infer_batch`."""
+    from PIL import Image
+
+    from inference import DonutInference
+
+    paths = sorted(
+        os.path.join(image_dir, name)
+        for name in os.listdir(image_dir)
+        if name.lower().endswith((".jpg", ".jpeg", ".png"))
+    )[:limit]
+    images = [Image.open(path).convert("RGB") for path in paths]
+
+    # fixed max_length, so every batch size decodes the same number of steps
+    model = DonutInference(model_pth=model_dir, device="cpu", adaptive_max_length=False)
+
+    # warm up, the first generate call pays one-off allocation costs
+    model.infer_batch(images[:1], batch_size=1)
+
+    results = {}
+    for batch_size in batch_sizes:
+        latencies = []
+        start = time.perf_counter()
+        for begin in range(0, len(images), batch_size):
+            call_start = time.perf_counter()
+            model.infer_batch(images[begin : begin + batch_size], batch_size=batch_size)
+            latencies.append(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+
+        results[str(batch_size)] = {
+            "images": len(images),
+            "images_per_sec": round(len(images) / elapsed, 3),
+            "batch_latency": latency_summary(latencies),
+        }
+    return results
+
+
+def load_records(key_dir: str, limit: int) -> list:
+    records = []
+    for name in sorted(os.listdir(key_dir))[:limit]:
+        with open(os.path.join(key_dir, name)) as f:
+            records.append(json.load(f))
+    return records
+
+
+def fresh_database(db_url: str):
+    """Database at `db_url` with the invoice tables dropped and created again."""
+    from src.database_utils import InvoiceDatabase
+
+    database = InvoiceDatabase(uri=db_url)
+    database.reset_tables()
+    return database
+
+
+def bench_ingest(db_url: str, records: list) -> dict:
+    """Rows/sec of `InvoiceDatabase.push_data` and `push_many`.
+
+    Each writer inserts the records into freshly created tables, so both
+    measure inserts rather than upserts of existing keys. Malformed records
+    are left out and counted.
+    """
+    database = fresh_database(db_url)
+    converted, invalid = database.rows_from_records(records)
+    valid = [records[idx] for idx in sorted(converted)]
+    rows = sum(2 + len(items) for _, items, _ in converted.values())
+
+    start = time.perf_counter()
+    for record in valid:
+        database.push_data(data=record)
+    push_data_seconds = time.perf_counter() - start
+    database.close_session()
+
+    database = fresh_database(db_url)
+    start = time.perf_counter()
+    failures = database.push_many(valid)
+    push_many_seconds = time.perf_counter() - start
+
+    return {
+        "invoices": len(valid),
+        "invalid_records": len(invalid),
+        "rows": rows,
+        "push_data_rows_per_sec": round(rows / push_data_seconds, 1),
+        "push_many_rows_per_sec": round(rows / push_many_seconds, 1),
+        "push_many_failures": len(failures),
+    }
+
+
+def bench_queries(db_url: str, repeats: int) -> dict:
+    """Latency of `get_data_from_query` for a few typical generated queries."""
+    from src.utils import get_data_from_query
+
+    queries = {
+        "count": "SELECT COUNT(*) FROM header;",
+        "join_aggregate": (
+            "SELECT h.seller, SUM(s.total_gross_worth) FROM header h "
+            "JOIN summary s ON s.invoice_no = h.invoice_no GROUP BY h.seller;"
+        ),
+        "rollup_per_seller": (
+            "SELECT seller, SUM(total_gross_worth) FROM seller_monthly_totals GROUP BY seller;"
+        ),
+        "scan_items": "SELECT * FROM items;",
+    }
+
+    results = {}
+    for name, sql in queries.items():
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            get_data_from_query(query=sql, db_url=db_url)
+            latencies.append(time.perf_counter() - start)
+        results[name] = latency_summary(latencies)
+    return results
+
+
+def bench_text(model_dir: str, repeats: int, new_tokens: int) -> dict:
+    """Latency of `TextInference.generate_text` on a schema prompt."""
+    from src.database_utils import Base, INTERNAL_TABLES
+    from src.db_models import Table, TableColumn
+    from src.llm import TextInference
+    from src.utils import PromptFormatterV1
+
+    tables = [
+        Table(
+            name=table.name,
+            columns=[TableColumn(name=col.name, dtype=str(col.type)) for col in table.columns],
+        )
+        for table in Base.metadata.sorted_tables
+        if table.name not in INTERNAL_TABLES
+    ]
+    formatter = PromptFormatterV1(tables=tables, db_type="SQLite")
+    prompt = formatter(question="What is the total gross worth per seller?")
+
+    model = TextInference(model_name=model_dir)
+    prompt_tokens = len(model.tokenizer(prompt).input_ids)
+
+    def run(prefix, tokens):
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.generate_text(
+                input_text=prompt, max_length=prompt_tokens + tokens, prefix=prefix
+            )
+            latencies.append(time.perf_counter() - start)
+        return latency_summary(latencies)
+
+    results = {"prompt_tokens": prompt_tokens, "new_tokens": new_tokens}
+    # with the prefix, the schema key/values are computed once and reused
+    for name, prefix in (("full_prompt", None), ("prefix_cached", formatter.prefix())):
+        results[name] = {
+            "time_to_first_token": run(prefix, 1),
+            "total": run(prefix, new_tokens),
+        }
+    return results
+
+
+def bench_startup(modules: list) -> dict:
+    """Cold import time of each module in a fresh interpreter, and whether it pulls in torch."""
+    import sys
+
+    script = (
+        "import json, sys, time; start = time.perf_counter(); import {module}; "
+        "print(json.dumps({{'seconds': round(time.perf_counter() - start, 4), "
+        "'torch_loaded': 'torch' in sys.modules, "
+        "'transformers_loaded': 'transformers' in sys.modules}}))"
+    )
+
+    results = {}
+    for module in modules:
+        completed = subprocess.run(
+            [sys.executable, "-c", script.format(module=module)], capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            results[module] = {"error": completed.stderr.strip().splitlines()[-1]}
+        else:
+            results[module] = json.loads(completed.stdout)
+    return results
+
+
+def environment() -> dict:
+    import torch
+    import transformers
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "transformers": transformers.__version__,
+    }
+
+
+def main(argv: list | None = None):
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the extraction, ingest and query paths."
+    )
+    parser.add_argument("--images", default="test_images", help="Folder of invoice images.")
+    parser.add_argument("--keys", default="data/key", help="Folder of parsed invoice jsons.")
+    parser.add_argument("--limit", type=int, default=32, help="Images and invoices used.")
+    parser.add_argument("--batch-sizes", default="1,2,4,8")
+    parser.add_argument("--repeats", type=int, default=20, help="Runs per latency measurement.")
+    parser.add_argument(
+        "--db-url",
+        help="Scratch database to benchmark, its invoice tables are dropped. "
+        "Defaults to a temporary SQLite file.",
+    )
+    parser.add_argument("--output", help="Write the results json here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    import torch
+
+    torch.manual_seed(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = args.db_url or f"sqlite:///{os.path.join(tmp, 'bench.sqlite')}"
+
+        results = {
+            "environment": environment(),
+            # the page and query path should load without torch, only `inference` needs it
+            "startup": bench_startup(
+                ["src.database_utils", "src.utils", "src.llm", "src.jobs", "inference"]
+            ),
+            "extraction": bench_extraction(
+                build_tiny_donut(os.path.join(tmp, "donut")),
+                args.images,
+                [int(size) for size in args.batch_sizes.split(",")],
+                args.limit,
+            ),
+            "ingest": bench_ingest(db_url, load_records(args.keys, args.limit)),
+            "query": bench_queries(db_url, args.repeats),
+            "text_to_sql": bench_text(
+                build_tiny_causal_lm(os.path.join(tmp, "text")), args.repeats, new_tokens=32
+            ),
+        }
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
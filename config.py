@@ -24,3 +24,76 @@ model_name_30 = "Rajan/AIMT-invoices-donut_30Epochs"
 
 # base comparison model
 model_name_base = "katanaml-org/invoices-donut-model-v1"
+
+
+# number of invoices stacked into one generate call
+extraction_batch_size = 8
+
+# ingest pipeline: image decode threads and invoices written per transaction
+ingest_decode_workers = 4
+ingest_commit_every = 32
+
+# on-disk cache of extracted invoices, keyed by image hash, model and generation params
+extraction_cache_enabled = True
+extraction_cache_path = ".cache/extractions.sqlite"
+extraction_cache_max_entries = 50000
+
+# shared sqlalchemy connection pool, one per connection url
+db_pool_size = 5
+db_max_overflow = 10
+db_pool_pre_ping = True
+db_pool_recycle = 1800
+db_pool_timeout = 30
+
+# local model server (model_server.py), None loads the models inside the UI process
+model_server_url = None
+model_server_host = "127.0.0.1"
+model_server_port = 8765
+
+# cpu inference: dynamic int8 quantization and torch thread pools (None keeps torch defaults)
+# check accuracy before enabling with: python -m src.evaluation --limit 50
+cpu_quantize = False
+cpu_quantize_encoder = False
+torch_num_threads = None
+torch_num_interop_threads = None
+
+# preprocessed pixel values kept as memory-mapped float16 arrays, None disables it
+pixel_cache_dir = ".cache/pixels"
+
+# background upload processing: worker threads and ui polling interval in seconds
+ingest_job_workers = 1
+ingest_poll_interval = 1.0
+
+# stage timings and counters (src/metrics.py), near free while disabled
+# metrics_log writes one log line per value, metrics_textfile a Prometheus textfile
+metrics_enabled = False
+metrics_log = False
+metrics_textfile = None
+metrics_flush_interval = 15.0
+
+# seconds allowed from process start to the first rendered ui page, models load in the background
+startup_budget_seconds = 5.0
+
+# pinned local model snapshots (src/model_registry.py), pin them with: python -m src.model_registry pin
+# revisions maps a model name to the hub revision to pin, unlisted names pin the current main
+model_registry_dir = ".cache/models"
+model_registry_offline = False
+model_revisions = {}
+text_model_name = "NumbersStation/nsql-350M"
+# run one short generate right after loading, so the first request is not slow
+model_warmup = True
+
+# text-to-SQL decoding: schema prompt prefixes whose key/values are kept (0 disables),
+# and tokens drafted by prompt lookup per step (None disables speculative decoding)
+text_prefix_cache_size = 4
+text_prompt_lookup_tokens = None
+
+# optional duckdb/parquet copy of the invoice tables for analytical questions (needs: pip install duckdb)
+# selects go to it while it is at most analytics_max_lag_versions writes behind the database
+analytics_mirror_enabled = False
+analytics_mirror_dir = ".cache/analytics"
+analytics_sync_interval = 30.0
+analytics_max_lag_versions = 0
+
+# rows per page of query results shown in the ui
+result_page_size = 100
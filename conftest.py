@@ -0,0 +1 @@
+# keeps the repository root importable from tests/, e.g. `import benchmark`
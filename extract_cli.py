@@ -0,0 +1,218 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+
+# image types picked up when a directory is given
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# marks a worker that finished its shard
+_DONE = "__done__"
+
+
+def list_sources(source: str) -> list:
+    """Image paths of a directory (recursive) or of a manifest with one path per line."""
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            paths.extend(
+                os.path.join(root, name)
+                for name in files
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        return sorted(paths)
+
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_checkpoint(path: str) -> set:
+    """Paths already written by a previous, possibly interrupted, run."""
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def worker(rank: int, paths: list, args: argparse.Namespace, results: mp.Queue):
+    """Loads the model once and extracts every image of its shard."""
+    import torch
+
+    from inference import DonutInference
+    from src.preprocess import Preprocessor, open_image
+    from src.utils import bytes_sha256
+
+    # a fixed thread budget per process, so N workers do not oversubscribe the cores
+    torch.set_num_threads(args.threads_per_worker)
+
+    # weights are memory-mapped from the pinned snapshot, the workers share one copy
+    model = DonutInference(model_pth=args.model, device="cpu", quantize=args.quantize)
+    target_size = Preprocessor(model.processor).target_size
+
+    for start in range(0, len(paths), args.batch_size):
+        chunk = paths[start : start + args.batch_size]
+        images, hashes, ok_paths = [], [], []
+        for path in chunk:
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+                images.append(open_image(content, target_size))
+                hashes.append(bytes_sha256(content))
+                ok_paths.append(path)
+            except Exception as e:
+                results.put((path, None, None, f"decode failed: {e}"))
+
+        if not images:
+            continue
+
+        try:
+            outputs = model.infer_batch(images, batch_size=args.batch_size)
+        except Exception as e:
+            for path in ok_paths:
+                results.put((path, None, None, f"inference failed: {e}"))
+            continue
+
+        for path, image_hash, data in zip(ok_paths, hashes, outputs):
+            results.put((path, image_hash, data, None))
+
+    results.put((_DONE, rank, None, None))
+
+
+def writer(args: argparse.Namespace, results: mp.Queue, workers: list, total: int):
+    """Single writer: appends JSONL, pushes to the database and checkpoints."""
+    database = None
+    if args.db:
+        from config import connection_url
+        from src.database_utils import InvoiceDatabase
+
+        database = InvoiceDatabase(uri=connection_url)
+        database.create_tables()
+
+    output = open(args.output, "a") if args.output else None
+    checkpoint = open(args.checkpoint, "a")
+
+    pending = []
+    done_workers, written, failed = 0, 0, 0
+    start = time.perf_counter()
+
+    def flush():
+        nonlocal written, failed
+        if not pending:
+            return
+
+        failures = {}
+        if database is not None:
+            failures = database.push_many(
+                [data for _, _, data in pending],
+                image_hashes=[image_hash for _, image_hash, _ in pending],
+            )
+
+        for idx, (path, image_hash, data) in enumerate(pending):
+            if idx in failures:
+                failed += 1
+                print(f"{path}: write failed: {failures[idx]}")
+                continue
+            if output is not None:
+                output.write(json.dumps({"path": path, "sha256": image_hash, "data": data}) + "\n")
+            checkpoint.write(path + "\n")
+            written += 1
+
+        # results first, then the checkpoint, so a resume never skips unwritten work
+        if output is not None:
+            output.flush()
+        checkpoint.flush()
+        pending.clear()
+
+    while done_workers < len(workers):
+        try:
+            path, image_hash, data, error = results.get(timeout=5)
+        except queue.Empty:
+            # a worker that died without finishing its shard will never report
+            if not any(process.is_alive() for process in workers):
+                print("All workers exited, the rest is picked up on the next run.")
+                break
+            continue
+
+        if path == _DONE:
+            done_workers += 1
+            continue
+
+        if error:
+            failed += 1
+            print(f"{path}: {error}")
+            continue
+
+        pending.append((path, image_hash, data))
+        if len(pending) >= args.commit_every:
+            flush()
+            elapsed = time.perf_counter() - start
+            print(f"{written}/{total} written, {failed} failed, {written / elapsed:.2f} img/s")
+
+    flush()
+
+    if output is not None:
+        output.close()
+    checkpoint.close()
+    print(f"Done: {written} written, {failed} failed in {time.perf_counter() - start:.1f}s")
+
+
+def main():
+    from config import model_name_30, extraction_batch_size, ingest_commit_every
+
+    parser = argparse.ArgumentParser(
+        description="Extract invoices from a folder or manifest with several worker processes."
+    )
+    parser.add_argument("source", help="Image directory, or a text file with one image path per line.")
+    parser.add_argument("--output", help="JSONL file the parsed invoices are appended to.")
+    parser.add_argument("--db", action="store_true", help="Also write invoices to the database.")
+    parser.add_argument("--checkpoint", help="Paths done so far, defaults to <output or source>.done")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=extraction_batch_size)
+    parser.add_argument("--commit-every", type=int, default=ingest_commit_every)
+    parser.add_argument("--model", default=model_name_30)
+    parser.add_argument("--quantize", action="store_true", help="Dynamic int8 quantization of the decoder.")
+    args = parser.parse_args()
+
+    if not args.output and not args.db:
+        parser.error("nothing to write, pass --output and/or --db")
+
+    args.checkpoint = args.checkpoint or f"{(args.output or args.source).rstrip('/')}.done"
+    args.threads_per_worker = args.threads_per_worker or max(
+        1, (os.cpu_count() or 1) // args.workers
+    )
+
+    done = load_checkpoint(args.checkpoint)
+    paths = [path for path in list_sources(args.source) if path not in done]
+    print(f"{len(paths)} images to process, {len(done)} already done, {args.workers} workers")
+    if not paths:
+        return
+
+    # pin the snapshot once here, instead of every worker downloading it at the same time
+    from transformers import VisionEncoderDecoderModel
+
+    from src.model_registry import model_registry
+
+    model_registry.resolve(args.model, model_cls=VisionEncoderDecoderModel)
+
+    # spawn keeps torch/openmp state of the parent out of the workers
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue(maxsize=args.workers * args.batch_size * 4)
+
+    workers = [
+        ctx.Process(target=worker, args=(rank, paths[rank :: args.workers], args, results))
+        for rank in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+
+    writer(args, results, workers=workers, total=len(paths))
+
+    for process in workers:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
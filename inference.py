@@ -1,12 +1,17 @@
-import io
 import re
-from typing import Any
-import urllib.request
-from io import BytesIO
+import threading
+from concurrent.futures import Future
+from typing import Any, Iterable, List
 
 import torch
 from PIL import Image
-from transformers import DonutProcessor, VisionEncoderDecoderModel
+from transformers import DonutProcessor, StoppingCriteriaList, VisionEncoderDecoderModel
+
+from src.decoding import InvoiceStoppingCriteria, LengthStats
+from src.metrics import metrics
+from src.model_registry import model_registry
+from src.scheduler import BatchScheduler
+from src.utils import LOOPED_KEY, image_sha256
 
 
 class Singleton(type):
@@ -17,45 +22,360 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
+def set_torch_threads(num_threads: int = None, num_interop_threads: int = None):
+    """Sets torch CPU thread pools, None keeps the torch default."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work started
+            pass
+
+
 class DonutInference(metaclass=Singleton):
-    def __init__(self, model_pth : str ,device: str = None):
-
-        self.processor = DonutProcessor.from_pretrained(model_pth)
-        self.model = VisionEncoderDecoderModel.from_pretrained(model_pth)
-        
-        if device:
-            self.device = device
-            self.model.to(device)
-            
-        else:
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+    task_prompt = "<s_cord-v2>"
 
-    def __call__(self, image) -> Any:
+    def __init__(
+        self,
+        model_pth: str,
+        device: str = None,
+        cache=None,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20,
+        quantize: bool = False,
+        quantize_encoder: bool = False,
+        num_threads: int = None,
+        num_interop_threads: int = None,
+        early_exit: bool = True,
+        adaptive_max_length: bool = True,
+    ):
+        """Loads the Donut processor and model.
 
-        # prepare encoder inputs
-        pixel_values = self.processor(image, return_tensors="pt").pixel_values
+        Args:
+            model_pth (str): Hub name or local folder of the model, hub names
+                are loaded from their pinned snapshot, see src/model_registry.py.
+            device (str, optional): Torch device, picks cuda when available.
+            cache (ExtractionCache, optional): Reuses outputs across runs.
+            max_batch_size (int): Max images per batch of the `submit` scheduler.
+            max_wait_ms (float): Max time a submitted image waits for a batch.
+            quantize (bool): On CPU, dynamic int8 quantization of the decoder linears.
+            quantize_encoder (bool): Also quantize the Swin encoder linears.
+            num_threads (int, optional): Torch intra-op threads.
+            num_interop_threads (int, optional): Torch inter-op threads.
+            early_exit (bool): Stop each row once `</s_summary>` closes or it loops.
+            adaptive_max_length (bool): Size max_length from observed output lengths.
+        """
+        set_torch_threads(num_threads, num_interop_threads)
+
+        self.model_pth = model_pth
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+        path = model_registry.resolve(model_pth, model_cls=VisionEncoderDecoderModel)
+        self.revision = model_registry.revision(model_pth)
+        self.processor = DonutProcessor.from_pretrained(path, local_files_only=True)
+        # on cpu the weights stay memory-mapped, processes loading the same snapshot share them
+        self.model = model_registry.load(
+            model_pth, VisionEncoderDecoderModel, mmap_weights=str(self.device) == "cpu"
+        )
+
+        # optional ExtractionCache, outputs are reused across runs for the same image
+        self.cache = cache
+
+        # concurrent single-image callers are batched together, see submit()
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._scheduler = None
+        self._scheduler_lock = threading.Lock()
+
+        self.model.to(self.device)
+        self.model.eval()
+
+        # decoding limits, see src/decoding.py
+        self.early_exit = early_exit
+        self.length_stats = LengthStats() if adaptive_max_length else None
+
+        # which parts of the model run int8, part of the cache key
+        self.quantized = None
+        if quantize:
+            self.quantize(encoder=quantize_encoder)
+
+    def quantize(self, encoder: bool = False):
+        """Dynamic int8 quantization of the linear layers, CPU only.
+
+        Args:
+            encoder (bool): Quantize the Swin encoder too, not only the BART decoder.
+        """
+        if str(self.device) != "cpu":
+            raise ValueError("Dynamic quantization is only supported on cpu.")
 
-        # prepare decoder inputs
-        task_prompt = "<s_cord-v2>"
-        decoder_input_ids = self.processor.tokenizer(task_prompt, add_special_tokens=False, return_tensors="pt").input_ids
-
-        # generate answer
-        outputs = self.model.generate(
-            pixel_values.to(self.device),
-            decoder_input_ids=decoder_input_ids.to(self.device),
-            max_length=self.model.decoder.config.max_position_embeddings,
-            early_stopping=True,
-            pad_token_id=self.processor.tokenizer.pad_token_id,
-            eos_token_id=self.processor.tokenizer.eos_token_id,
-            use_cache=True,
-            num_beams=1,
-            bad_words_ids=[[self.processor.tokenizer.unk_token_id]],
-            return_dict_in_generate=True,
+        self.model.decoder = torch.ao.quantization.quantize_dynamic(
+            self.model.decoder, {torch.nn.Linear}, dtype=torch.qint8
         )
+        self.quantized = "decoder"
+
+        if encoder:
+            self.model.encoder = torch.ao.quantization.quantize_dynamic(
+                self.model.encoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            self.quantized = "decoder+encoder"
+
+    def warmup(self):
+        """Runs a short generate on a blank page, so the first real request does
+        not pay for lazy allocations and kernel selection."""
+        size = self.processor.image_processor.size
+        image = Image.new("RGB", (size["width"], size["height"]), "white")
+        pixel_values = self.processor(image, return_tensors="pt").pixel_values
+
+        decoder_input_ids = self.processor.tokenizer(
+            self.task_prompt, add_special_tokens=False, return_tensors="pt"
+        ).input_ids
+
+        with torch.inference_mode():
+            self.model.generate(
+                pixel_values.to(self.device),
+                decoder_input_ids=decoder_input_ids.to(self.device),
+                max_length=decoder_input_ids.shape[1] + 4,
+                pad_token_id=self.processor.tokenizer.pad_token_id,
+                eos_token_id=self.processor.tokenizer.eos_token_id,
+                use_cache=True,
+                num_beams=1,
+            )
+
+    def __call__(self, image) -> Any:
+        return self.submit(image).result()
+
+    @property
+    def scheduler(self) -> BatchScheduler:
+        """Micro-batching scheduler shared by every caller of this model."""
+        with self._scheduler_lock:
+            if self._scheduler is None:
+                self._scheduler = BatchScheduler(
+                    self._run_scheduled,
+                    max_batch_size=self.max_batch_size,
+                    max_wait_ms=self.max_wait_ms,
+                )
+        return self._scheduler
+
+    def submit(self, image, image_hash: str = None) -> Future:
+        """Queues one image for batched extraction, the future resolves to its json.
+
+        Args:
+            image: A PIL image, or its pixel values as prepared by `processor`
+                (one image, without the batch dimension).
+            image_hash (str, optional): sha256 of the image file, for the cache.
+        """
+        return self.scheduler.submit((image, image_hash))
+
+    def _run_scheduled(self, items: list) -> List[dict]:
+        results = [None] * len(items)
+        prepared = [idx for idx, (image, _) in enumerate(items) if isinstance(image, torch.Tensor)]
+        raw = [idx for idx, (image, _) in enumerate(items) if not isinstance(image, torch.Tensor)]
+
+        if prepared:
+            outputs = self.generate(
+                torch.stack([items[idx][0] for idx in prepared]),
+                image_hashes=[items[idx][1] for idx in prepared],
+            )
+            for idx, output in zip(prepared, outputs):
+                results[idx] = output
+
+        if raw:
+            hashes = [items[idx][1] for idx in raw]
+            outputs = self.infer_batch(
+                [items[idx][0] for idx in raw],
+                batch_size=len(raw),
+                image_hashes=hashes if all(hashes) else None,
+            )
+            for idx, output in zip(raw, outputs):
+                results[idx] = output
+        return results
+
+    @property
+    def model_id(self) -> str:
+        """Model name plus the hub revision it was loaded at, when known."""
+        revision = self.revision or getattr(self.model.config, "_commit_hash", None)
+        return f"{self.model_pth}@{revision}" if revision else self.model_pth
+
+    def generation_params(self) -> dict:
+        """Settings that change the generated output, part of the cache key.
+
+        Rows cut at the adaptive cap are decoded again in full, so every output
+        is what the full decoder length gives and `max_length` is that length.
+        """
+        return {
+            "task_prompt": self.task_prompt,
+            "max_length": self.model.decoder.config.max_position_embeddings,
+            "num_beams": 1,
+            "quantized": self.quantized,
+            "early_exit": self.early_exit,
+        }
+
+    def cache_lookup(self, image_hash: str) -> dict | None:
+        """Cached output for an image hash, None on a miss or without a cache."""
+        if self.cache is None or image_hash is None:
+            return None
+        return self.cache.get(image_hash, self.model_id, self.generation_params())
+
+    def infer_batch(
+        self, images: Iterable, batch_size: int = 8, image_hashes: Iterable = None
+    ) -> List[dict]:
+        """Runs extraction over many images, `batch_size` images per generate call.
+
+        Args:
+            images (Iterable): PIL images to parse.
+            batch_size (int): Number of images stacked into one generate call.
+            image_hashes (Iterable, optional): sha256 of each image file. Only used
+                for the cache, computed from the pixels when not given.
+
+        Returns:
+            List[dict]: One `token2json` output per image, in input order.
+        """
+        images = list(images)
+        results = [None] * len(images)
+
+        if self.cache is not None and self.cache.enabled:
+            hashes = list(image_hashes or [image_sha256(img) for img in images])
+        else:
+            hashes = [None] * len(images)
+
+        # only the cache misses go through the model
+        pending = []
+        for idx, image_hash in enumerate(hashes):
+            results[idx] = self.cache_lookup(image_hash)
+            if results[idx] is None:
+                pending.append(idx)
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start : start + batch_size]
+
+            # prepare encoder inputs, the processor stacks the batch for us
+            with metrics.timer("preprocess_seconds"):
+                pixel_values = self.processor(
+                    [images[idx].convert("RGB") for idx in chunk], return_tensors="pt"
+                ).pixel_values
+
+            outputs = self.generate(
+                pixel_values, image_hashes=[hashes[idx] for idx in chunk]
+            )
+            for idx, output in zip(chunk, outputs):
+                results[idx] = output
+
+        return results
+
+    def generate(self, pixel_values: torch.Tensor, image_hashes: Iterable = None) -> List[dict]:
+        """Generates and parses one sequence per row of `pixel_values`.
+
+        Outputs are stored in the cache under `image_hashes` when both are set.
+        Rows the early exit stopped in a repetition loop are marked with
+        `LOOPED_KEY` and never cached.
+        """
+
+        # prepare decoder inputs, same task prompt for every image in the batch
+        decoder_input_ids = self.processor.tokenizer(
+            self.task_prompt, add_special_tokens=False, return_tensors="pt"
+        ).input_ids.repeat(pixel_values.shape[0], 1)
+
+        prompt_length = decoder_input_ids.shape[1]
+        full_length = self.model.decoder.config.max_position_embeddings
+        max_length = full_length
+        if self.length_stats is not None:
+            max_length = min(
+                full_length,
+                prompt_length + self.length_stats.max_length(full_length - prompt_length),
+            )
+
+        sequences, lengths, looped = self._generate(pixel_values, decoder_input_ids, max_length)
+
+        # rows that hit the adaptive cap may be cut short, decode them again in full
+        capped = [row for row, length in enumerate(lengths) if length >= max_length - prompt_length]
+        if capped and max_length < full_length:
+            metrics.count("adaptive_reruns_total", len(capped), model="donut")
+            rerun, rerun_lengths, rerun_looped = self._generate(
+                pixel_values[capped], decoder_input_ids[capped], full_length
+            )
+            for row, sequence, length, row_looped in zip(capped, rerun, rerun_lengths, rerun_looped):
+                sequences[row] = sequence
+                lengths[row] = length
+                looped[row] = row_looped
+
+        if self.length_stats is not None:
+            self.length_stats.observe(lengths, max_length=full_length - prompt_length)
 
         # postprocess
-        sequence = self.processor.batch_decode(outputs.sequences)[0]
+        with metrics.timer("token2json_seconds"):
+            results = [
+                self.postprocess(sequence)
+                for sequence in self.processor.batch_decode(sequences)
+            ]
+
+        # a looped row is cut off garbage, flag it instead of passing it on as an invoice
+        if any(looped):
+            metrics.count("looped_rows_total", sum(looped), model="donut")
+            for row in range(len(results)):
+                if looped[row]:
+                    result = results[row] if isinstance(results[row], dict) else {}
+                    results[row] = {**result, LOOPED_KEY: True}
+
+        if self.cache is not None and image_hashes is not None:
+            params = self.generation_params()
+            for image_hash, result, row_looped in zip(image_hashes, results, looped):
+                if image_hash and not row_looped:
+                    self.cache.put(image_hash, self.model_id, params, result)
+
+        return results
+
+    def _generate(self, pixel_values: torch.Tensor, decoder_input_ids: torch.Tensor, max_length: int):
+        """Greedy decode of a batch.
+
+        Returns the sequences, the generated lengths and whether the early exit
+        stopped the row in a repetition loop, per row.
+        """
+        prompt_length = decoder_input_ids.shape[1]
+
+        stopping_criteria = StoppingCriteriaList()
+        invoice_criteria = None
+        if self.early_exit:
+            invoice_criteria = InvoiceStoppingCriteria.from_tokenizer(
+                self.processor.tokenizer, prompt_length=prompt_length
+            )
+            stopping_criteria.append(invoice_criteria)
+
+        # generate answer, finished rows are padded until the whole batch is done
+        with torch.inference_mode(), metrics.timer("generate_seconds", model="donut") as timer:
+            outputs = self.model.generate(
+                pixel_values.to(self.device),
+                decoder_input_ids=decoder_input_ids.to(self.device),
+                max_length=max_length,
+                stopping_criteria=stopping_criteria,
+                early_stopping=True,
+                pad_token_id=self.processor.tokenizer.pad_token_id,
+                eos_token_id=self.processor.tokenizer.eos_token_id,
+                use_cache=True,
+                num_beams=1,
+                bad_words_ids=[[self.processor.tokenizer.unk_token_id]],
+                return_dict_in_generate=True,
+            )
+
+        generated = outputs.sequences[:, prompt_length:]
+        lengths = (generated != self.processor.tokenizer.pad_token_id).sum(dim=1).tolist()
+
+        if metrics.enabled:
+            metrics.observe("batch_size", len(lengths), model="donut")
+            metrics.count("generated_tokens_total", sum(lengths), model="donut")
+            if timer.elapsed > 0:
+                metrics.observe("tokens_per_second", sum(lengths) / timer.elapsed, model="donut")
+
+        looped = [False] * len(lengths)
+        if invoice_criteria is not None and invoice_criteria.looped is not None:
+            looped = invoice_criteria.looped.tolist()
+
+        return list(outputs.sequences), lengths, looped
+
+    def postprocess(self, sequence: str) -> dict:
+        """Strips special tokens from a decoded sequence and converts it to json."""
         sequence = sequence.replace(self.processor.tokenizer.eos_token, "").replace(self.processor.tokenizer.pad_token, "")
         sequence = re.sub(r"<.*?>", "", sequence, count=1).strip()  # remove first task start token
 
-        return self.processor.token2json(sequence)
\ No newline at end of file
+        return self.processor.token2json(sequence)
@@ -0,0 +1,228 @@
+import argparse
+import base64
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+from src.scheduler import BatchScheduler
+from src.utils import bytes_sha256
+
+
+class ModelServer:
+    def __init__(
+        self,
+        extractor,
+        text_model,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+        batch_size: int = 8,
+        max_wait_ms: float = 20,
+    ):
+        """Keeps the Donut and nsql models resident and serves them over HTTP.
+
+        Any objects with the `DonutInference.infer_batch` and
+        `TextInference.generate_text` signatures can be served, which lets
+        tests run the server with stub models.
+
+        Args:
+            extractor: Invoice extraction model, e.g. `DonutInference`.
+            text_model: Text-to-SQL model, e.g. `TextInference`.
+            host (str): Interface to bind.
+            port (int): Port to bind, 0 picks a free one.
+            batch_size (int): Max images per generate call.
+            max_wait_ms (float): Max time an image waits for others to share its batch.
+        """
+        self.extractor = extractor
+        self.text_model = text_model
+        self.batch_size = batch_size
+
+        # images from concurrent requests are micro-batched into one generate call
+        self.extract_scheduler = BatchScheduler(
+            self._run_extract, max_batch_size=batch_size, max_wait_ms=max_wait_ms
+        )
+
+        # generate calls are not re-entrant, one text request at a time
+        self.text_lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def extract(self, contents: list) -> list:
+        """Parses a list of raw image files, one json per image."""
+        futures = [
+            self.extract_scheduler.submit(
+                (Image.open(BytesIO(content)), bytes_sha256(content))
+            )
+            for content in contents
+        ]
+        return [future.result() for future in futures]
+
+    def _run_extract(self, items: list) -> list:
+        return self.extractor.infer_batch(
+            [image for image, _ in items],
+            batch_size=self.batch_size,
+            image_hashes=[image_hash for _, image_hash in items],
+        )
+
+    def generate_text(self, prompts: list, max_length: int, prefix: str | None = None) -> list:
+        with self.text_lock:
+            return [
+                self.text_model.generate_text(
+                    input_text=prompt, max_length=max_length, prefix=prefix
+                )
+                for prompt in prompts
+            ]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, payload: dict):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self._reply(200, {"status": "ok"})
+                elif self.path == "/stats":
+                    self._reply(200, {"extract": server.extract_scheduler.stats()})
+                else:
+                    self._reply(404, {"error": f"unknown path {self.path}"})
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length) or b"{}")
+
+                    if self.path == "/extract":
+                        contents = [base64.b64decode(image) for image in request["images"]]
+                        self._reply(200, {"results": server.extract(contents)})
+
+                    elif self.path == "/sql":
+                        outputs = server.generate_text(
+                            request["prompts"],
+                            max_length=request.get("max_length", 500),
+                            prefix=request.get("prefix"),
+                        )
+                        self._reply(200, {"outputs": outputs})
+
+                    else:
+                        self._reply(404, {"error": f"unknown path {self.path}"})
+
+                except (KeyError, ValueError) as e:
+                    self._reply(400, {"error": f"bad request: {e}"})
+                except Exception as e:
+                    self._reply(500, {"error": str(e)})
+
+            def log_message(self, format, *args):
+                # keep per-request access logs out of the console
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        print(f"Model server listening on {self.url}")
+        self.httpd.serve_forever()
+
+    def start(self) -> threading.Thread:
+        """Serves from a background thread, handy for tests and notebooks."""
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.extract_scheduler.shutdown()
+
+
+def main():
+    from config import (
+        model_name_30,
+        extraction_batch_size,
+        model_server_host,
+        model_server_port,
+        extraction_cache_enabled,
+        extraction_cache_path,
+        extraction_cache_max_entries,
+        cpu_quantize,
+        cpu_quantize_encoder,
+        torch_num_threads,
+        torch_num_interop_threads,
+        text_model_name,
+        text_prefix_cache_size,
+        text_prompt_lookup_tokens,
+        model_warmup,
+    )
+    import torch
+
+    from inference import DonutInference
+    from src.extraction_cache import ExtractionCache
+    from src.llm import TextInference
+    from src.model_registry import warm_up
+
+    parser = argparse.ArgumentParser(description="Serve the invoice and text-to-SQL models.")
+    parser.add_argument("--host", default=model_server_host)
+    parser.add_argument("--port", type=int, default=model_server_port)
+    parser.add_argument("--model", default=model_name_30, help="Donut model to serve.")
+    parser.add_argument("--batch-size", type=int, default=extraction_batch_size)
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=20,
+        help="How long an image may wait for others to fill its batch.",
+    )
+    args = parser.parse_args()
+
+    # both models are loaded once and stay resident for the life of the server
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    extractor = DonutInference(
+        model_pth=args.model,
+        device=device,
+        quantize=cpu_quantize and device == "cpu",
+        quantize_encoder=cpu_quantize_encoder,
+        num_threads=torch_num_threads,
+        num_interop_threads=torch_num_interop_threads,
+        cache=ExtractionCache(
+            path=extraction_cache_path,
+            max_entries=extraction_cache_max_entries,
+            enabled=extraction_cache_enabled,
+        ),
+    )
+    text_model = TextInference(
+        model_name=text_model_name,
+        prefix_cache_size=text_prefix_cache_size,
+        prompt_lookup_num_tokens=text_prompt_lookup_tokens,
+    )
+    if model_warmup:
+        warm_up(extractor)
+        warm_up(text_model)
+
+    server = ModelServer(
+        extractor=extractor,
+        text_model=text_model,
+        host=args.host,
+        port=args.port,
+        batch_size=args.batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
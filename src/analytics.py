@@ -0,0 +1,351 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import Boolean, Date, Integer, BigInteger, Numeric, select, func
+
+from src.database_utils import Header, Item, Summary, ROLLUPS
+from src.db_pool import engine_pool
+from src.metrics import metrics
+
+# invoice tables mirrored, the rollups are views over them
+MIRRORED = {"header": Header, "items": Item, "summary": Summary}
+
+# partition of invoices without a parseable date
+_UNKNOWN_MONTH = "unknown"
+
+
+def _duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "The analytics mirror needs duckdb, install it with: pip install duckdb"
+        ) from e
+    return duckdb
+
+
+def _duckdb_type(column) -> str:
+    if isinstance(column.type, Date):
+        return "DATE"
+    if isinstance(column.type, (Integer, BigInteger)):
+        return "BIGINT"
+    if isinstance(column.type, Numeric):
+        return "DOUBLE"
+    if isinstance(column.type, Boolean):
+        return "BOOLEAN"
+    return "VARCHAR"
+
+
+class AnalyticsMirror:
+    def __init__(self, database, root: str = ".cache/analytics", chunk_size: int = 1000) -> None:
+        """Copy of header, items and summary as month partitioned Parquet, queried with DuckDB.
+
+        `sync` only copies invoices written since the last sync, found through
+        `header.row_version`, and rewrites just the month partitions they are
+        in (or were in). Aggregate questions then run on the columnar copy,
+        off the database that takes the ingest writes.
+
+        Args:
+            database (InvoiceDatabase): The source database.
+            root (str): Folder of the Parquet files and the sync watermark.
+            chunk_size (int): Invoices fetched per source query.
+        """
+        self.database = database
+        self.root = root
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+        self._connection = None
+        self._views_ready = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.root, "_mirror.json")
+
+    def meta(self) -> dict:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"version": None, "synced_at": None, "invoices": 0}
+
+    def _write_meta(self, meta: dict):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def lag(self) -> dict:
+        """How far the mirror is behind the database."""
+        meta = self.meta()
+        version = self.database.data_version()
+        return {
+            "synced_version": meta["version"],
+            "source_version": version,
+            "versions_behind": None if meta["version"] is None else version - meta["version"],
+            "seconds_since_sync": (
+                None if meta["synced_at"] is None else round(time.time() - meta["synced_at"], 1)
+            ),
+        }
+
+    def _partition_path(self, table: str, month: str) -> str:
+        return os.path.join(self.root, table, f"month={month}", "data.parquet")
+
+    def _fetch(self, table: str, invoice_nos: list | None) -> pd.DataFrame:
+        """Rows of `table` for the given invoices, or for all of them when None.
+
+        Every row comes with the invoice month of its header as `_month`.
+        """
+        source = MIRRORED[table].__table__
+        header = Header.__table__
+
+        if table == "header":
+            stmt = select(*source.c, source.c.invoice_month.label("_month"))
+        else:
+            stmt = select(*source.c, header.c.invoice_month.label("_month")).select_from(
+                source.join(header, header.c.invoice_no == source.c.invoice_no)
+            )
+        if invoice_nos is not None:
+            stmt = stmt.where(source.c.invoice_no.in_(invoice_nos))
+
+        with engine_pool.connect(self.database.uri) as connection:
+            result = connection.execute(stmt)
+            return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    def _changed_invoices(self, since: int) -> list:
+        header = Header.__table__
+        with engine_pool.connect(self.database.uri) as connection:
+            rows = connection.execute(
+                select(header.c.invoice_no).where(header.c.row_version > since)
+            ).fetchall()
+        return [invoice_no for (invoice_no,) in rows]
+
+    def _source_count(self) -> int:
+        with engine_pool.connect(self.database.uri) as connection:
+            return connection.execute(select(func.count()).select_from(Header.__table__)).scalar()
+
+    def _write_partition(self, connection, table: str, month: str, frame: pd.DataFrame):
+        path = self._partition_path(table, month)
+        if frame.empty:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            return
+
+        columns = MIRRORED[table].__table__.columns
+        projection = ", ".join(
+            f'CAST("{column.name}" AS {_duckdb_type(column)}) AS "{column.name}"'
+            for column in columns
+        )
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        connection.register("_partition", frame)
+        try:
+            connection.execute(
+                f"COPY (SELECT {projection} FROM _partition) TO '{tmp_path}' (FORMAT PARQUET)"
+            )
+        finally:
+            connection.unregister("_partition")
+        os.replace(tmp_path, path)
+
+    def _read_partition(self, connection, table: str, month: str) -> pd.DataFrame:
+        path = self._partition_path(table, month)
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=[column.name for column in MIRRORED[table].__table__.columns])
+        return connection.execute("SELECT * FROM read_parquet(?)", [path]).df()
+
+    def _partitions(self, table: str) -> list:
+        folder = os.path.join(self.root, table)
+        if not os.path.isdir(folder):
+            return []
+        return [name.split("=", 1)[1] for name in os.listdir(folder) if name.startswith("month=")]
+
+    @staticmethod
+    def _month_key(value) -> str:
+        if value is None or pd.isna(value):
+            return _UNKNOWN_MONTH
+        return pd.Timestamp(value).strftime("%Y-%m")
+
+    def sync(self, full: bool = False) -> dict:
+        """Copies the invoices written since the last sync into the mirror.
+
+        Args:
+            full (bool): Rebuild from scratch, also done when the mirror is new
+                or the database lost rows, e.g. after `clear_all_tables`.
+
+        Returns:
+            dict: Number of invoices copied and the version synced to.
+        """
+        with self._lock, metrics.timer("mirror_sync_seconds"):
+            duckdb = _duckdb()
+            meta = self.meta()
+            # read before the rows, anything written meanwhile is picked up again next time
+            version = self.database.data_version()
+            full = full or meta["version"] is None or self._source_count() < meta["invoices"]
+
+            if full:
+                for table in MIRRORED:
+                    shutil.rmtree(os.path.join(self.root, table), ignore_errors=True)
+                changed = None
+            elif version == meta["version"]:
+                return {"invoices": 0, "version": version}
+            else:
+                changed = self._changed_invoices(meta["version"])
+
+            connection = duckdb.connect()
+            invoices = 0
+            chunks = [None] if changed is None else [
+                changed[start : start + self.chunk_size]
+                for start in range(0, len(changed), self.chunk_size)
+            ]
+            for chunk in chunks:
+                invoices += self._sync_chunk(connection, chunk)
+
+            connection.close()
+            self._write_meta(
+                {"version": version, "synced_at": time.time(), "invoices": self._source_count()}
+            )
+            metrics.count("mirror_invoices_synced_total", invoices)
+            return {"invoices": invoices, "version": version}
+
+    def _sync_chunk(self, connection, invoice_nos: list | None) -> int:
+        """Replaces the rows of `invoice_nos` in every partition they touch."""
+        count = 0
+        for table in MIRRORED:
+            fresh = self._fetch(table, invoice_nos)
+            if table == "header":
+                count = len(fresh)
+            fresh["_month"] = fresh["_month"].map(self._month_key)
+
+            # partitions the invoices are in now, plus the ones holding their old rows
+            months = set(fresh["_month"])
+            if invoice_nos is not None:
+                months |= self._months_holding(connection, table, invoice_nos)
+
+            for month in months:
+                existing = self._read_partition(connection, table, month)
+                if invoice_nos is not None and not existing.empty:
+                    existing = existing[~existing["invoice_no"].isin(invoice_nos)]
+                update = fresh[fresh["_month"] == month].drop(columns="_month")
+                frame = pd.concat([existing, self._typed(table, update)], ignore_index=True)
+                self._write_partition(connection, table, month, frame)
+        return count
+
+    def _months_holding(self, connection, table: str, invoice_nos: list) -> set:
+        pattern = os.path.join(self.root, table, "*", "*.parquet")
+        if not self._partitions(table):
+            return set()
+        rows = connection.execute(
+            "SELECT DISTINCT filename FROM read_parquet(?, filename=true, hive_partitioning=false) "
+            "WHERE invoice_no IN (SELECT UNNEST(?))",
+            [pattern, list(invoice_nos)],
+        ).fetchall()
+        return {os.path.basename(os.path.dirname(path)).split("=", 1)[1] for (path,) in rows}
+
+    @staticmethod
+    def _typed(table: str, frame: pd.DataFrame) -> pd.DataFrame:
+        """Decimal and date objects as float and datetime columns DuckDB can scan."""
+        frame = frame.copy()
+        for column in MIRRORED[table].__table__.columns:
+            if isinstance(column.type, Numeric):
+                frame[column.name] = pd.to_numeric(frame[column.name], errors="coerce")
+            elif isinstance(column.type, Date):
+                frame[column.name] = pd.to_datetime(frame[column.name], errors="coerce")
+        return frame
+
+    def _views(self, connection):
+        """Views named like the database tables, so generated SQL runs unchanged."""
+        for table in MIRRORED:
+            pattern = os.path.join(self.root, table, "*", "*.parquet")
+            connection.execute(
+                f"CREATE OR REPLACE VIEW {table} AS "
+                f"SELECT * FROM read_parquet('{pattern}', hive_partitioning=false)"
+            )
+
+        for column, model in ROLLUPS.items():
+            connection.execute(
+                f"""CREATE OR REPLACE VIEW {model.__tablename__} AS
+                SELECT h.{column}, h.invoice_month AS month, COUNT(*) AS invoice_count,
+                       SUM(s.total_net_worth) AS total_net_worth,
+                       SUM(s.total_vat) AS total_vat,
+                       SUM(s.total_gross_worth) AS total_gross_worth
+                FROM header h JOIN summary s ON s.invoice_no = h.invoice_no
+                WHERE h.{column} IS NOT NULL AND h.invoice_month IS NOT NULL
+                GROUP BY h.{column}, h.invoice_month"""
+            )
+
+    def query(self, sql: str) -> pd.DataFrame:
+        """Runs a SELECT on the mirror."""
+        with self._lock:
+            if self._connection is None:
+                self._connection = _duckdb().connect()
+            # fails until the first sync wrote files, retried on the next query
+            if not self._views_ready:
+                self._views(self._connection)
+                self._views_ready = True
+            cursor = self._connection.cursor()
+
+        with metrics.timer("sql_execute_seconds", backend="mirror"):
+            return cursor.execute(sql).df()
+
+    def start(self, interval: float = 30.0):
+        """Syncs on a background thread every `interval` seconds."""
+        if self._thread is not None:
+            return self
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"Analytics mirror sync failed: {e}")
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=loop, daemon=True, name="analytics-mirror")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class QueryRouter:
+    def __init__(self, db_url: str, mirror: AnalyticsMirror | None = None, max_lag_versions: int = 0) -> None:
+        """Sends SELECTs to the analytics mirror when it is fresh enough, else to the database.
+
+        Args:
+            db_url (str): Connection url of the database.
+            mirror (AnalyticsMirror, optional): None always uses the database.
+            max_lag_versions (int): Data versions the mirror may be behind.
+        """
+        self.db_url = db_url
+        self.mirror = mirror
+        self.max_lag_versions = max_lag_versions
+
+    def query(self, sql: str) -> tuple:
+        """Runs `sql` and returns (DataFrame, backend name, mirror lag or None)."""
+        from src.utils import get_data_from_query
+
+        if self.mirror is not None:
+            lag = self.mirror.lag()
+            behind = lag["versions_behind"]
+            if behind is not None and behind <= self.max_lag_versions:
+                try:
+                    return self.mirror.query(sql), "mirror", lag
+                except Exception as e:
+                    # postgres syntax duckdb does not take, the database answers instead
+                    metrics.count("mirror_fallbacks_total", error=type(e).__name__)
+            else:
+                metrics.count("mirror_fallbacks_total", error="stale")
+
+        return get_data_from_query(query=sql, db_url=self.db_url), "database", None
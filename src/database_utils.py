@@ -1,26 +1,81 @@
-from sqlalchemy import create_engine, Column, Integer, String, Numeric, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker
+import math
+from datetime import datetime
+
+from sqlalchemy import (
+    bindparam,
+    select,
+    tuple_,
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Integer,
+    String,
+    Numeric,
+    ForeignKey,
+    Text,
+    UniqueConstraint,
+    func,
+    inspect,
+)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import declarative_base, relationship, selectinload
+
+from src.db_pool import engine_pool
+from src.db_connector import invalidate_schema_cache
+from src.metrics import metrics
+from src.normalize import normalize_invoices, parse_numbers
+from src.utils import LOOPED_KEY
 
 Base = declarative_base()
 
+# invoice date layouts, tried in order, month first is what the invoices use
+DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%d.%m.%Y", "%m-%d-%Y", "%d/%m/%Y")
+
+
+def parse_date(value):
+    """Parses an invoice date string, None when no known layout matches."""
+    if not value:
+        return None
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
 
 # Define the Header table
 class Header(Base):
     __tablename__ = "header"
     invoice_no = Column(String, primary_key=True)
-    invoice_date = Column(String)
-    seller = Column(String)
-    client = Column(String)
+    invoice_date = Column(Date, index=True)
+    # first day of the invoice month, the key of the monthly rollups
+    invoice_month = Column(Date, index=True)
+    # date as printed on the invoice, kept when it could not be parsed
+    invoice_date_raw = Column(String)
+    seller = Column(String, index=True)
+    client = Column(String, index=True)
     seller_tax_id = Column(String)
     client_tax_id = Column(String)
     iban = Column(String)
+    # data version of the write that last touched the invoice, drives incremental mirroring
+    row_version = Column(BigInteger, index=True)
+
+    items = relationship("Item", order_by="Item.line_no", viewonly=True)
+    summary = relationship("Summary", uselist=False, viewonly=True)
 
 
 # Define the Items table
 class Item(Base):
     __tablename__ = "items"
+    __table_args__ = (UniqueConstraint("invoice_no", "line_no"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
-    invoice_no = Column(String, ForeignKey("header.invoice_no"))
+    invoice_no = Column(String, ForeignKey("header.invoice_no"), index=True)
+    # position of the item on the invoice, identifies the row on re-upload
+    line_no = Column(Integer)
     item_desc = Column(String)
     item_qty = Column(Numeric)
     item_net_price = Column(Numeric)
@@ -33,97 +88,487 @@ class Item(Base):
 class Summary(Base):
     __tablename__ = "summary"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    invoice_no = Column(String, ForeignKey("header.invoice_no"))
+    invoice_no = Column(String, ForeignKey("header.invoice_no"), unique=True)
     total_net_worth = Column(Numeric)
     total_vat = Column(Numeric)
     total_gross_worth = Column(Numeric)
+    # whether the totals agree with the sum of the items, None when they could not be compared
+    totals_match = Column(Boolean)
+
+
+# Define the monthly rollup tables, recomputed for the touched keys on every write
+class SellerMonthlyTotal(Base):
+    __tablename__ = "seller_monthly_totals"
+    seller = Column(String, primary_key=True)
+    month = Column(Date, primary_key=True)
+    invoice_count = Column(Integer)
+    total_net_worth = Column(Numeric)
+    total_vat = Column(Numeric)
+    total_gross_worth = Column(Numeric)
+
+
+class ClientMonthlyTotal(Base):
+    __tablename__ = "client_monthly_totals"
+    client = Column(String, primary_key=True)
+    month = Column(Date, primary_key=True)
+    invoice_count = Column(Integer)
+    total_net_worth = Column(Numeric)
+    total_vat = Column(Numeric)
+    total_gross_worth = Column(Numeric)
+
+
+# rollup table per header column it groups by
+ROLLUPS = {"seller": SellerMonthlyTotal, "client": ClientMonthlyTotal}
+
+
+# Define the ImageHash table, remembers which upload produced which invoice
+class ImageHash(Base):
+    __tablename__ = "image_hashes"
+    sha256 = Column(String(64), primary_key=True)
+    invoice_no = Column(String, ForeignKey("header.invoice_no"))
+
+
+# Define the IngestJob table, one row per uploaded file processed in the background
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, index=True)
+    filename = Column(String)
+    path = Column(String)
+    # pending, running, done, skipped or failed
+    status = Column(String, index=True, default="pending")
+    error = Column(Text)
+    invoice_no = Column(String)
+    # json of seconds spent per pipeline stage
+    timings = Column(Text)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+# Define the DataVersion table, a single counter bumped by every write
+class DataVersion(Base):
+    __tablename__ = "data_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+# bookkeeping tables, not part of the invoice data the LLM is asked about
+INTERNAL_TABLES = {"image_hashes", "data_version", "ingest_jobs"}
 
 
 class InvoiceDatabase:
     def __init__(self, uri):
-        self.engine = create_engine(uri)
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
+        # engine and session registry are shared with every other user of `uri`
+        self.uri = uri
+        self.engine = engine_pool.get_engine(uri)
+        self.Session = engine_pool.session_factory(uri)
+
+    @property
+    def session(self):
+        """Session of the calling thread."""
+        return self.Session()
+
+    def close_session(self):
+        """Returns the calling thread's session connection to the pool."""
+        self.Session.remove()
 
     def create_tables(self):
+        existing = set(inspect(self.engine).get_table_names())
         Base.metadata.create_all(self.engine)
 
-    def push_data(self, data):
-        # Insert data into the Header table
-        header = Header(
-            invoice_no=data["header"]["invoice_no"],
-            invoice_date=data["header"]["invoice_date"],
-            seller=data["header"]["seller"],
-            client=data["header"]["client"],
-            seller_tax_id=data["header"]["seller_tax_id"],
-            client_tax_id=data["header"]["client_tax_id"],
-            iban=data["header"]["iban"],
+        # memoized schema lookups are only stale if tables were added
+        if set(Base.metadata.tables) - existing:
+            invalidate_schema_cache()
+
+        # seed the data version counter
+        with self.engine.begin() as connection:
+            exists = connection.execute(
+                select(DataVersion.__table__.c.id).where(DataVersion.__table__.c.id == 1)
+            ).first()
+            if not exists:
+                connection.execute(
+                    DataVersion.__table__.insert().values(id=1, version=0)
+                )
+
+    def reset_tables(self):
+        """Drops and recreates every table but the data version counter.
+
+        `create_tables` never alters a table that already exists, so this is how
+        a database created by an older version gets the current columns and
+        constraints. All invoices and jobs are lost, the data version is bumped
+        so cached query results and the analytics mirror are not reused.
+        """
+        tables = [
+            table for name, table in Base.metadata.tables.items()
+            if name != DataVersion.__tablename__
+        ]
+        Base.metadata.drop_all(self.engine, tables=tables)
+        self.create_tables()
+        with self.engine.begin() as connection:
+            self._bump_data_version(connection)
+
+    def data_version(self):
+        """Current data version, changes whenever invoice data is written."""
+        table = DataVersion.__table__
+        with engine_pool.connect(self.uri) as connection:
+            version = connection.execute(
+                select(table.c.version).where(table.c.id == 1)
+            ).scalar()
+        return version or 0
+
+    def _bump_data_version(self, connection):
+        """Increments the data version and returns the new value.
+
+        The update locks the counter row until commit, so concurrent writers get
+        distinct versions that become visible in version order.
+        """
+        table = DataVersion.__table__
+        connection.execute(
+            table.update().where(table.c.id == 1).values(version=table.c.version + 1)
         )
-        self.session.add(header)
-
-        # Insert data into the Items table
-        for item in data["items"]:
-            new_item = Item(
-                invoice_no=data["header"]["invoice_no"],
-                item_desc=item["item_desc"],
-                item_qty=self.convert_to_numeric(item["item_qty"]),
-                item_net_price=self.convert_to_numeric(item["item_net_price"]),
-                item_net_worth=self.convert_to_numeric(item["item_net_worth"]),
-                item_vat=self.convert_percentage(item["item_vat"]),
-                item_gross_worth=self.convert_to_numeric(item["item_gross_worth"]),
+        return connection.execute(select(table.c.version).where(table.c.id == 1)).scalar()
+
+    def push_data(self, data, image_hash=None, commit=True):
+        # Upsert the header, items and summary rows of the invoice
+        rows = self.to_rows(data)
+        with metrics.timer("db_write_seconds", method="push_data"):
+            self._insert_rows(
+                self.session.connection(),
+                [rows],
+                hashes=self._hash_rows([data], [image_hash]),
             )
-            self.session.add(new_item)
-
-        # Insert data into the Summary table
-        summary = Summary(
-            invoice_no=data["header"]["invoice_no"],
-            total_net_worth=self.convert_to_numeric(data["summary"]["total_net_worth"]),
-            total_vat=self.convert_to_numeric(data["summary"]["total_vat"]),
-            total_gross_worth=self.convert_to_numeric(
-                data["summary"]["total_gross_worth"]
+
+        # Commit the session, callers batching several invoices commit themselves
+        if commit:
+            with metrics.timer("db_commit_seconds", method="push_data"):
+                self.session.commit()
+        metrics.count("db_rows_written_total", self._row_count([rows]), method="push_data")
+
+    def push_many(self, records, image_hashes=None):
+        """Writes many parsed invoices with bulk upserts, one transaction per call.
+
+        The records are flattened into column-wise row batches and written with one
+        executemany per table. If the batch is rejected, every record is retried in
+        its own savepoint so a bad invoice only fails itself.
+
+        Args:
+            records (Iterable[dict]): Parsed invoices, as accepted by `push_data`.
+            image_hashes (Iterable[str], optional): sha256 of the image each record
+                was extracted from, aligned with `records`.
+
+        Returns:
+            dict: Maps the index of every record that was not written to its error.
+        """
+        records = list(records)
+        image_hashes = list(image_hashes or [None] * len(records))
+
+        # convert every record up front, malformed ones never reach the database
+        rows, failures = self.rows_from_records(records)
+        converted = [
+            (idx, record_rows, self._hash_rows([records[idx]], [image_hashes[idx]]))
+            for idx, record_rows in rows.items()
+        ]
+
+        if not converted:
+            return failures
+
+        with metrics.timer("db_write_seconds", method="push_many"), self.engine.begin() as connection:
+            try:
+                with connection.begin_nested():
+                    self._insert_rows(
+                        connection,
+                        [rows for _, rows, _ in converted],
+                        hashes=[row for _, _, hashes in converted for row in hashes],
+                    )
+            except SQLAlchemyError:
+                # fall back to one savepoint per record to find the bad ones
+                for idx, rows, hashes in converted:
+                    try:
+                        with connection.begin_nested():
+                            self._insert_rows(connection, [rows], hashes=hashes)
+                    except SQLAlchemyError as e:
+                        failures[idx] = str(getattr(e, "orig", None) or e)
+
+        if metrics.enabled:
+            written = [rows for idx, rows, _ in converted if idx not in failures]
+            metrics.observe("db_batch_size", len(written))
+            metrics.count("db_rows_written_total", self._row_count(written), method="push_many")
+        return failures
+
+    def to_rows(self, data):
+        """Converts a parsed invoice into header, item and summary table rows."""
+        rows, failures = self.rows_from_records([data])
+        if failures:
+            raise ValueError(failures[0])
+        return rows[0]
+
+    def rows_from_records(self, records):
+        """Converts many parsed invoices into table rows, numbers parsed column-wise.
+
+        Args:
+            records (list[dict]): Parsed invoices.
+
+        Returns:
+            tuple: (index -> (header, items, summary) rows, index -> error) for
+                the records that could and could not be converted.
+        """
+        normalized = normalize_invoices(records)
+        failures = dict(normalized.failures)
+        rows = {}
+
+        for idx, (items, summary) in normalized.by_record().items():
+            if records[idx].get(LOOPED_KEY):
+                failures[idx] = "the decoder looped, output not trusted"
+                continue
+            try:
+                header = self._header_row(records[idx])
+            except (KeyError, TypeError, AttributeError) as e:
+                failures[idx] = f"malformed record: {e!r}"
+                continue
+            invoice_no = header["invoice_no"]
+            rows[idx] = (
+                header,
+                [{"invoice_no": invoice_no, **item} for item in items],
+                {"invoice_no": invoice_no, **summary},
+            )
+        return rows, failures
+
+    @staticmethod
+    def _header_row(data):
+        header = {
+            column: data["header"][column]
+            for column in (
+                "invoice_no",
+                "invoice_date",
+                "seller",
+                "client",
+                "seller_tax_id",
+                "client_tax_id",
+                "iban",
+            )
+        }
+        invoice_date = parse_date(header["invoice_date"])
+        header["invoice_date_raw"] = header["invoice_date"]
+        header["invoice_date"] = invoice_date
+        header["invoice_month"] = invoice_date.replace(day=1) if invoice_date else None
+        return header
+
+    def _hash_rows(self, records, image_hashes):
+        """Builds image_hashes rows for the records that came with a hash."""
+        return [
+            {"sha256": image_hash, "invoice_no": data["header"]["invoice_no"]}
+            for data, image_hash in zip(records, image_hashes)
+            if image_hash
+        ]
+
+    def _upsert(self, table, index_elements):
+        """INSERT ... ON CONFLICT DO UPDATE statement for `table`."""
+        if self.engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        elif self.engine.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            raise NotImplementedError(
+                f"Upserts not implemented for {self.engine.dialect.name}."
+            )
+
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={
+                column.name: stmt.excluded[column.name]
+                for column in table.columns
+                if column.name not in index_elements and not column.primary_key
+            },
+        )
+
+    @staticmethod
+    def _row_count(batch):
+        """Number of table rows in a list of (header, items, summary) rows."""
+        return sum(2 + len(items) for _, items, _ in batch)
+
+    def _insert_rows(self, connection, batch, hashes=()):
+        """Upserts a list of (header, items, summary) rows, one statement per table."""
+        # invalidates cached query results, commits together with the rows
+        version = self._bump_data_version(connection)
+
+        headers = [{**header, "row_version": version} for header, _, _ in batch]
+        items = [item for _, record_items, _ in batch for item in record_items]
+        summaries = [summary for _, _, summary in batch]
+
+        # rollup keys the rows belonged to before this write, a re-upload may move them
+        header_table = Header.__table__
+        previous = connection.execute(
+            select(*(header_table.c[column] for column in ROLLUPS), header_table.c.invoice_month)
+            .where(header_table.c.invoice_no.in_([header["invoice_no"] for header in headers]))
+        ).fetchall()
+
+        # headers go first, items and summary reference them
+        connection.execute(self._upsert(Header.__table__, ["invoice_no"]), headers)
+        if items:
+            connection.execute(
+                self._upsert(Item.__table__, ["invoice_no", "line_no"]), items
+            )
+
+        # a re-upload with fewer lines leaves stale items behind, drop them
+        items_table = Item.__table__
+        connection.execute(
+            items_table.delete().where(
+                items_table.c.invoice_no == bindparam("b_invoice_no"),
+                items_table.c.line_no >= bindparam("b_line_count"),
             ),
+            [
+                {"b_invoice_no": header["invoice_no"], "b_line_count": len(record_items)}
+                for header, record_items, _ in batch
+            ],
+        )
+
+        connection.execute(self._upsert(Summary.__table__, ["invoice_no"]), summaries)
+        if hashes:
+            connection.execute(self._upsert(ImageHash.__table__, ["sha256"]), hashes)
+
+        self._refresh_rollups(
+            connection,
+            [dict(zip([*ROLLUPS, "invoice_month"], row)) for row in previous] + headers,
         )
-        self.session.add(summary)
 
-        # Commit the session
-        self.session.commit()
+    def _refresh_rollups(self, connection, headers):
+        """Recomputes the rollup rows of every (key, month) pair found in `headers`."""
+        header_table = Header.__table__
+        summary_table = Summary.__table__
+
+        for column, model in ROLLUPS.items():
+            keys = {
+                (header[column], header["invoice_month"])
+                for header in headers
+                if header[column] is not None and header["invoice_month"] is not None
+            }
+            if not keys:
+                continue
+            keys = list(keys)
+
+            rollup = model.__table__
+            connection.execute(
+                rollup.delete().where(tuple_(rollup.c[column], rollup.c.month).in_(keys))
+            )
+            connection.execute(
+                rollup.insert().from_select(
+                    [
+                        column,
+                        "month",
+                        "invoice_count",
+                        "total_net_worth",
+                        "total_vat",
+                        "total_gross_worth",
+                    ],
+                    select(
+                        header_table.c[column],
+                        header_table.c.invoice_month,
+                        func.count(),
+                        func.sum(summary_table.c.total_net_worth),
+                        func.sum(summary_table.c.total_vat),
+                        func.sum(summary_table.c.total_gross_worth),
+                    )
+                    .select_from(
+                        header_table.join(
+                            summary_table,
+                            summary_table.c.invoice_no == header_table.c.invoice_no,
+                        )
+                    )
+                    .where(
+                        tuple_(header_table.c[column], header_table.c.invoice_month).in_(keys)
+                    )
+                    .group_by(header_table.c[column], header_table.c.invoice_month),
+                )
+            )
+
+    def known_hashes(self, hashes):
+        """Looks up image hashes that were already ingested.
+
+        Args:
+            hashes (Iterable[str]): sha256 hex digests of image files.
+
+        Returns:
+            dict: Maps every already seen hash to the invoice_no it produced.
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+
+        table = ImageHash.__table__
+        with engine_pool.connect(self.uri) as connection:
+            rows = connection.execute(
+                select(table.c.sha256, table.c.invoice_no).where(
+                    table.c.sha256.in_(hashes)
+                )
+            ).fetchall()
+        return {sha256: invoice_no for sha256, invoice_no in rows}
 
     def convert_to_numeric(self, value):
-        """Converts a string with currency symbols or commas to a numeric value."""
+        """Converts a string with currency symbols or separators to a numeric value."""
         if value is None:
             return None
-        value = (
-            value.replace("$", "").replace(",", ".").replace(" ", "")
-        )  # Remove spaces
-        try:
-            return float(value)
-        except ValueError:
-            return None
+        number = parse_numbers([value])[0]
+        return None if math.isnan(number) else float(number)
 
     def convert_percentage(self, value):
         """Converts a percentage string to a numeric value."""
-        if value is None:
-            return None
-        value = (
-            value.replace("%", "").replace(",", ".").replace(" ", "")
-        )  # Remove spaces
-        try:
-            return float(value)
-        except ValueError:
-            return None
+        return self.convert_to_numeric(value)
 
     def fetch_record(self, invoice_no):
-        header = self.session.query(Header).filter_by(invoice_no=invoice_no).first()
-        items = self.session.query(Item).filter_by(invoice_no=invoice_no).all()
-        summary = self.session.query(Summary).filter_by(invoice_no=invoice_no).first()
+        return next(self.fetch_records([invoice_no]), None)
 
-        if not header:
-            return None
+    def fetch_records(self, invoice_nos=None, filter=None, chunk_size=500):
+        """Yields parsed invoices with their items and summary, in invoice_no order.
 
+        Headers are loaded `chunk_size` at a time, items and summaries with one
+        selectin query each per chunk, so a chunk costs three queries however
+        many invoices it holds. Rows are streamed, only one chunk is in memory.
+
+        Args:
+            invoice_nos (Iterable[str], optional): Invoices to load, missing ones
+                are skipped.
+            filter (optional): SQLAlchemy condition on `Header`, e.g.
+                `Header.seller == "ACME"`. All invoices when both are None.
+            chunk_size (int): Invoices loaded per round of queries.
+
+        Yields:
+            dict: Invoice in the shape `push_data` takes, plus `totals_match`.
+        """
+        session = self.Session.session_factory()
+        try:
+            query = session.query(Header).options(
+                selectinload(Header.items), selectinload(Header.summary)
+            )
+            if filter is not None:
+                query = query.filter(filter)
+            query = query.order_by(Header.invoice_no)
+
+            if invoice_nos is None:
+                chunks = [query.yield_per(chunk_size)]
+            else:
+                invoice_nos = sorted(set(invoice_nos))
+                chunks = (
+                    query.filter(Header.invoice_no.in_(invoice_nos[start : start + chunk_size]))
+                    for start in range(0, len(invoice_nos), chunk_size)
+                )
+
+            for chunk in chunks:
+                for header in chunk:
+                    yield self._record_dict(header)
+        finally:
+            session.close()
+
+    @staticmethod
+    def _record_dict(header):
+        def number(value):
+            return None if value is None else float(value)
+
+        summary = header.summary
         return {
             "header": {
                 "invoice_no": header.invoice_no,
-                "invoice_date": header.invoice_date,
+                "invoice_date": header.invoice_date_raw,
                 "seller": header.seller,
                 "client": header.client,
                 "seller_tax_id": header.seller_tax_id,
@@ -133,23 +578,27 @@ class InvoiceDatabase:
             "items": [
                 {
                     "item_desc": item.item_desc,
-                    "item_qty": float(item.item_qty),
-                    "item_net_price": float(item.item_net_price),
-                    "item_net_worth": float(item.item_net_worth),
-                    "item_vat": float(item.item_vat),
-                    "item_gross_worth": float(item.item_gross_worth),
+                    "item_qty": number(item.item_qty),
+                    "item_net_price": number(item.item_net_price),
+                    "item_net_worth": number(item.item_net_worth),
+                    "item_vat": number(item.item_vat),
+                    "item_gross_worth": number(item.item_gross_worth),
                 }
-                for item in items
+                for item in header.items
             ],
             "summary": {
-                "total_net_worth": float(summary.total_net_worth),
-                "total_vat": float(summary.total_vat),
-                "total_gross_worth": float(summary.total_gross_worth),
+                "total_net_worth": number(summary.total_net_worth) if summary else None,
+                "total_vat": number(summary.total_vat) if summary else None,
+                "total_gross_worth": number(summary.total_gross_worth) if summary else None,
+                "totals_match": summary.totals_match if summary else None,
             },
         }
 
     def clear_all_tables(self):
-        with self.engine.connect() as connection:
+        with self.engine.begin() as connection:
             connection.execute(
-                "TRUNCATE TABLE header, items, summary RESTART IDENTITY CASCADE;"
+                "TRUNCATE TABLE header, items, summary, image_hashes, "
+                "seller_monthly_totals, client_monthly_totals RESTART IDENTITY CASCADE;"
             )
+            self._bump_data_version(connection)
+
@@ -2,9 +2,11 @@ import re
 import sqlalchemy.exc
 from typing import Literal
 from typing import Iterable
-from sqlalchemy import create_engine
+from sqlalchemy import inspect, text
 
-from src.db_models import TableColumn, Table
+from src.db_pool import engine_pool
+
+from src.db_models import TableColumn, Table, ForeignKey
 
 
 class DatabaseAgent:
@@ -53,15 +55,13 @@ class DatabaseAgent:
         # get the connection string
         connection_str = self.__generate_conn_str()
 
-        engine = create_engine(connection_str)
-
         try:
-            engine.connect()
-            print("Connection to MySQL database successful!")
+            with engine_pool.connect(connection_str):
+                print(f"Connection to {self.db_type} database successful!")
 
         except Exception as e:
 
-            raise f"Error connecting to MySQL database: {e}"
+            raise ConnectionError(f"Error connecting to {self.db_type} database: {e}")
 
     def grab_table_names(self) -> Iterable:
         """Grabs all the table names in the database.
@@ -73,52 +73,167 @@ class DatabaseAgent:
         # get the database url
         url = self.__generate_conn_str()
 
-        # create the engine
-        engine = create_engine(url=url)
+        key = (url, "table_names")
+        if key not in _schema_cache:
+            # Grab the table names from sql alchemy, using the shared engine
+            _schema_cache[key] = engine_pool.get_engine(url).table_names()
 
-        # Grab the table names from sql alchemy
-        table_names = engine.table_names()
+        return list(_schema_cache[key])
 
-        # delete the table names after tables have been extracted
-        engine.dispose()
+    def grab_table_schema(self, tables: Iterable) -> Iterable[Table]:
+        """Grabs columns, primary keys and foreign keys of the given tables.
 
-        return table_names
+        The catalog is read once and memoized until `invalidate_schema_cache`
+        is called, which happens whenever `InvoiceDatabase.create_tables` adds tables.
 
-    def grab_table_schema(self, tables: Iterable) -> Iterable[Table]:
+        Args:
+            tables (Iterable): Names of the tables to describe.
 
-        # store the schemas
-        schemas = []
+        Returns:
+            Iterable[Table]: One Table per name, in the given order.
+        """
 
         # get the database url
         url = self.__generate_conn_str()
 
-        # create the engine
-        engine = create_engine(url=url)
-
-        # iterate over the tables
-        for table in tables:
-            # store the columns data
-            columns = []
-
-            if self.db_type == "SQLite":
-                sql = f"PRAGMA table_info({table});"
-
+        tables = list(tables)
+        key = (url, "schema", tuple(sorted(tables)))
+        if key not in _schema_cache:
+            if self.db_type == "PostgreSQL":
+                described = self.__describe_postgres(url, tables)
             else:
-                sql = f"""
-                    SELECT column_name, data_type
-                    FROM information_schema.columns
-                    WHERE table_name = '{table}';
-                """
+                described = self.__describe_generic(url, tables)
+            _schema_cache[key] = described
 
-            # grab the schema from the sql query.
-            schema = engine.execute(sql).fetchall()
+        described = _schema_cache[key]
 
-            # iterate over the schemas
-            for column_name, d_type in schema:
-                columns.append(TableColumn(name=column_name, dtype=d_type))
+        # return the schemas
+        return [described[table] for table in tables if table in described]
+
+    def __describe_postgres(self, url: str, tables: list) -> dict:
+        """Reads columns, pks and fks of all tables with one catalog query."""
+
+        with engine_pool.connect(url) as connection:
+            rows = connection.execute(
+                text(_POSTGRES_CATALOG_SQL), {"tables": tables}
+            ).fetchall()
+
+        columns, pks, fks = {}, {}, {}
+        for table, column, d_type, is_pk, ref_table, ref_column, ref_type in rows:
+            col = TableColumn(name=column, dtype=d_type)
+
+            # a column can show up once per constraint it belongs to
+            if column not in {c.name for c in columns.setdefault(table, [])}:
+                columns[table].append(col)
+            if is_pk and column not in {c.name for c in pks.setdefault(table, [])}:
+                pks[table].append(col)
+            if ref_table:
+                fks.setdefault(table, []).append(
+                    ForeignKey(
+                        column=col,
+                        references_name=ref_table,
+                        references_column=TableColumn(name=ref_column, dtype=ref_type),
+                    )
+                )
+
+        return {
+            table: Table(
+                name=table,
+                columns=columns[table],
+                pks=pks.get(table) or None,
+                fks=fks.get(table) or None,
+            )
+            for table in columns
+        }
 
-            # save the schemas in schemas directory.
-            schemas.append(Table(name=table, columns=columns))
+    def __describe_generic(self, url: str, tables: list) -> dict:
+        """Falls back to the SQLAlchemy inspector for the other databases."""
 
-        # return the schemas
-        return schemas
+        inspector = inspect(engine_pool.get_engine(url))
+        described = {}
+
+        for table in tables:
+            columns = {
+                column["name"]: TableColumn(name=column["name"], dtype=str(column["type"]))
+                for column in inspector.get_columns(table)
+            }
+            pk_names = inspector.get_pk_constraint(table).get("constrained_columns") or []
+
+            fks = []
+            for fk in inspector.get_foreign_keys(table):
+                for column, ref_column in zip(
+                    fk["constrained_columns"], fk["referred_columns"]
+                ):
+                    fks.append(
+                        ForeignKey(
+                            column=columns[column],
+                            references_name=fk["referred_table"],
+                            references_column=TableColumn(name=ref_column, dtype=None),
+                        )
+                    )
+
+            described[table] = Table(
+                name=table,
+                columns=list(columns.values()),
+                pks=[columns[name] for name in pk_names] or None,
+                fks=fks or None,
+            )
+
+        return described
+
+
+# memoized catalog lookups, keyed by connection string
+_schema_cache = {}
+
+
+def invalidate_schema_cache():
+    """Drops memoized table names and schemas, call after any DDL."""
+    _schema_cache.clear()
+
+
+# columns of every requested table with their primary key flag and fk target
+_POSTGRES_CATALOG_SQL = """
+    SELECT
+        c.table_name,
+        c.column_name,
+        c.data_type,
+        pk.column_name IS NOT NULL AS is_pk,
+        fk.references_name,
+        fk.references_column,
+        ref.data_type AS references_type
+    FROM information_schema.columns c
+    LEFT JOIN (
+        SELECT kcu.table_name, kcu.column_name
+        FROM information_schema.table_constraints tc
+        JOIN information_schema.key_column_usage kcu
+            ON kcu.constraint_name = tc.constraint_name
+            AND kcu.table_schema = tc.table_schema
+        WHERE tc.constraint_type = 'PRIMARY KEY'
+            AND tc.table_schema = current_schema()
+    ) pk
+        ON pk.table_name = c.table_name AND pk.column_name = c.column_name
+    LEFT JOIN (
+        SELECT
+            kcu.table_name,
+            kcu.column_name,
+            ccu.table_name AS references_name,
+            ccu.column_name AS references_column
+        FROM information_schema.table_constraints tc
+        JOIN information_schema.key_column_usage kcu
+            ON kcu.constraint_name = tc.constraint_name
+            AND kcu.table_schema = tc.table_schema
+        JOIN information_schema.constraint_column_usage ccu
+            ON ccu.constraint_name = tc.constraint_name
+            AND ccu.constraint_schema = tc.table_schema
+        WHERE tc.constraint_type = 'FOREIGN KEY'
+            AND tc.table_schema = current_schema()
+    ) fk
+        ON fk.table_name = c.table_name AND fk.column_name = c.column_name
+    LEFT JOIN information_schema.columns ref
+        ON ref.table_schema = c.table_schema
+        AND ref.table_name = fk.references_name
+        AND ref.column_name = fk.references_column
+    WHERE c.table_schema = current_schema()
+        AND c.table_name = ANY(:tables)
+    ORDER BY c.table_name, c.ordinal_position
+"""
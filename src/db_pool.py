@@ -0,0 +1,205 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+
+class PoolMetrics:
+    """Checkout counters and wait times of one engine pool."""
+
+    def __init__(self) -> None:
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        # timed checkouts, including those that failed or timed out
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def observe_wait(self, seconds: float):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checked_out": self.checked_out,
+                "wait_seconds_total": round(self.wait_seconds_total, 4),
+                "wait_seconds_max": round(self.wait_seconds_max, 4),
+                "wait_seconds_mean": round(
+                    self.wait_seconds_total / self.waits if self.waits else 0.0, 6
+                ),
+            }
+
+
+class EnginePool:
+    def __init__(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_pre_ping: bool = True,
+        pool_recycle: int = 1800,
+        pool_timeout: int = 30,
+    ) -> None:
+        """Hands out one shared engine and scoped session factory per connection URL.
+
+        Args:
+            pool_size (int): Connections kept open per URL.
+            max_overflow (int): Extra connections allowed above `pool_size` under load.
+            pool_pre_ping (bool): Test connections on checkout, drops dead ones.
+            pool_recycle (int): Seconds after which a connection is reopened.
+            pool_timeout (int): Seconds to wait for a free connection before failing.
+        """
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_pre_ping = pool_pre_ping
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
+
+        self._engines = {}
+        self._sessions = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _engine_kwargs(self, url: str) -> dict:
+        kwargs = {"pool_pre_ping": self.pool_pre_ping}
+
+        # sqlite uses its own pool classes that take no sizing arguments
+        if make_url(url).get_backend_name() != "sqlite":
+            kwargs.update(
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                pool_recycle=self.pool_recycle,
+                pool_timeout=self.pool_timeout,
+            )
+        return kwargs
+
+    def get_engine(self, url: str):
+        """Returns the engine for `url`, creating it on first use."""
+        url = str(url)
+        with self._lock:
+            engine = self._engines.get(url)
+            if engine is None:
+                engine = create_engine(url, **self._engine_kwargs(url))
+                self._metrics[url] = self._instrument(engine)
+                self._engines[url] = engine
+        return engine
+
+    def _instrument(self, engine) -> PoolMetrics:
+        metrics = PoolMetrics()
+
+        def time_checkouts(pool):
+            # every checkout goes through pool.connect, sessions and raw engine use included
+            connect = pool.connect
+
+            def timed_connect():
+                start = time.perf_counter()
+                try:
+                    return connect()
+                finally:
+                    metrics.observe_wait(time.perf_counter() - start)
+
+            pool.connect = timed_connect
+
+        time_checkouts(engine.pool)
+
+        @event.listens_for(engine, "engine_disposed")
+        def on_dispose(engine):
+            # dispose replaces the pool
+            time_checkouts(engine.pool)
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            metrics.add(connects=1)
+
+        @event.listens_for(engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            metrics.add(checkouts=1, checked_out=1)
+
+        @event.listens_for(engine, "checkin")
+        def on_checkin(dbapi_connection, connection_record):
+            metrics.add(checkins=1, checked_out=-1)
+
+        return metrics
+
+    @contextmanager
+    def connect(self, url: str):
+        """Checks out a pooled connection of `url`, closed again on exit."""
+        connection = self.get_engine(url).connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def session_factory(self, url: str) -> scoped_session:
+        """Thread-local session registry bound to the shared engine of `url`."""
+        url = str(url)
+        engine = self.get_engine(url)
+        with self._lock:
+            factory = self._sessions.get(url)
+            if factory is None:
+                factory = scoped_session(sessionmaker(bind=engine))
+                self._sessions[url] = factory
+        return factory
+
+    def stats(self, url: str | None = None) -> dict:
+        """Pool metrics for one URL, or for every URL when none is given."""
+        if url is not None:
+            return self._stats_for(str(url))
+        return {known: self._stats_for(known) for known in list(self._engines)}
+
+    def _stats_for(self, url: str) -> dict:
+        engine = self._engines.get(url)
+        if engine is None:
+            return {}
+        stats = self._metrics[url].as_dict()
+        stats["pool"] = engine.pool.status()
+        return stats
+
+    def dispose(self):
+        """Closes every pooled connection, engines are recreated on next use."""
+        with self._lock:
+            for factory in self._sessions.values():
+                factory.remove()
+            for engine in self._engines.values():
+                engine.dispose()
+            self._sessions.clear()
+            self._engines.clear()
+            self._metrics.clear()
+
+
+def _from_config() -> EnginePool:
+    from config import (
+        db_pool_size,
+        db_max_overflow,
+        db_pool_pre_ping,
+        db_pool_recycle,
+        db_pool_timeout,
+    )
+
+    return EnginePool(
+        pool_size=db_pool_size,
+        max_overflow=db_max_overflow,
+        pool_pre_ping=db_pool_pre_ping,
+        pool_recycle=db_pool_recycle,
+        pool_timeout=db_pool_timeout,
+    )
+
+
+# process wide pool manager, every module shares it
+engine_pool = _from_config()
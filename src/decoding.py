@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+
+import torch
+from transformers import StoppingCriteria
+
+
+class InvoiceStoppingCriteria(StoppingCriteria):
+    def __init__(
+        self,
+        end_token_id: int | None,
+        prompt_length: int,
+        max_period: int = 16,
+        min_repeats: int = 4,
+        min_span: int = 32,
+        pad_token_id: int | None = None,
+    ) -> None:
+        """Stops each row of a batched decode as soon as its invoice json is complete.
+
+        A row is finished once it emits the closing tag of the last section of
+        the invoice schema (`</s_summary>`), or once its tail is the same
+        n-gram repeated at least `min_repeats` times over at least `min_span`
+        tokens, which only happens when the decoder got stuck in a loop.
+
+        Args:
+            end_token_id (int, optional): Id of the closing tag, None disables it.
+            prompt_length (int): Number of decoder prompt tokens to skip.
+            max_period (int): Longest repeated n-gram that is detected.
+            min_repeats (int): Repetitions of an n-gram that count as a loop.
+            min_span (int): Shortest looping tail, keeps runs like "0000" legal.
+            pad_token_id (int, optional): Padding of rows that already finished.
+        """
+        self.end_token_id = end_token_id
+        self.prompt_length = prompt_length
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_span = min_span
+        self.pad_token_id = pad_token_id
+
+        # per row, whether it was stopped because of a repetition loop
+        self.looped = None
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, prompt_length: int, end_tag: str = "</s_summary>", **kwargs):
+        end_token_id = tokenizer.convert_tokens_to_ids(end_tag)
+        if end_token_id == tokenizer.unk_token_id:
+            end_token_id = None
+        return cls(
+            end_token_id=end_token_id,
+            prompt_length=prompt_length,
+            pad_token_id=tokenizer.pad_token_id,
+            **kwargs,
+        )
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids[:, self.prompt_length :]
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        if self.looped is None:
+            self.looped = torch.zeros_like(done)
+
+        if generated.shape[1] == 0:
+            return done
+
+        if self.end_token_id is not None:
+            done |= generated[:, -1] == self.end_token_id
+
+        looped = self._repeating(generated)
+
+        # finished rows are padded, a run of padding is not a loop
+        if self.pad_token_id is not None:
+            looped &= generated[:, -1] != self.pad_token_id
+        self.looped |= looped & ~done
+
+        return done | looped
+
+    def _repeating(self, generated: torch.LongTensor) -> torch.BoolTensor:
+        batch, length = generated.shape
+        looped = torch.zeros(batch, dtype=torch.bool, device=generated.device)
+
+        for period in range(1, self.max_period + 1):
+            repeats = max(self.min_repeats, -(-self.min_span // period))
+            span = period * repeats
+            if span > length:
+                continue
+
+            # the tail split into `repeats` chunks of `period` tokens, all equal
+            tail = generated[:, -span:].reshape(batch, repeats, period)
+            looped |= (tail == tail[:, -1:, :]).all(dim=2).all(dim=1)
+
+        return looped
+
+
+class LengthStats:
+    def __init__(
+        self,
+        window: int = 1000,
+        min_samples: int = 32,
+        percentile: float = 99,
+        margin: float = 1.25,
+        floor: int = 128,
+    ) -> None:
+        """Keeps recent output lengths and derives a max_length from them.
+
+        Until `min_samples` outputs were seen, the caller's cap is used as is.
+
+        Args:
+            window (int): Number of recent output lengths kept.
+            min_samples (int): Outputs needed before the limit adapts.
+            percentile (float): Length percentile the limit is based on.
+            margin (float): Head room multiplied onto that percentile.
+            floor (int): Smallest limit ever suggested.
+        """
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.margin = margin
+        self.floor = floor
+
+        self.truncated = 0
+        self._lengths = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, lengths, max_length: int):
+        """Records generated lengths, counting those that hit `max_length`."""
+        with self._lock:
+            for length in lengths:
+                self._lengths.append(int(length))
+                if length >= max_length:
+                    self.truncated += 1
+
+    def max_length(self, cap: int) -> int:
+        with self._lock:
+            if len(self._lengths) < self.min_samples:
+                return cap
+            ordered = sorted(self._lengths)
+
+        rank = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.floor, min(cap, int(ordered[rank] * self.margin)))
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            lengths = list(self._lengths)
+        return {
+            "samples": len(lengths),
+            "mean_length": sum(lengths) / len(lengths) if lengths else 0.0,
+            "max_length_seen": max(lengths, default=0),
+            "truncated": self.truncated,
+        }
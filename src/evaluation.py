@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import time
+from typing import Callable, Iterable, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def load_local_samples(
+    image_dir: str = "data/image", key_dir: str = "data/key", limit: int = None
+) -> List[Tuple[Image.Image, dict]]:
+    """Pairs `invoice_*.jpg` images with their `invoice_*.json` ground truth."""
+    samples = []
+    for name in sorted(os.listdir(key_dir)):
+        stem, _ = os.path.splitext(name)
+        image_pth = os.path.join(image_dir, f"{stem}.jpg")
+        if not os.path.exists(image_pth):
+            continue
+
+        with open(os.path.join(key_dir, name)) as f:
+            ground_truth = json.load(f)
+        samples.append((Image.open(image_pth).convert("RGB"), ground_truth))
+
+        if limit and len(samples) >= limit:
+            break
+    return samples
+
+
+def evaluate(
+    infer: Callable[[List[Image.Image]], List[dict]],
+    samples: Iterable[Tuple[Image.Image, dict]],
+    batch_size: int = 8,
+) -> dict:
+    """Scores predictions with the same metrics as `testing.ipynb`.
+
+    Args:
+        infer (Callable): Maps a list of images to a list of parsed jsons,
+            e.g. `DonutInference.infer_batch`.
+        samples (Iterable): (image, ground truth json) pairs.
+        batch_size (int): Images per `infer` call.
+
+    Returns:
+        dict: mean f1/accuracy/recall/precision and seconds per invoice.
+    """
+    from donut import JSONParseEvaluator
+
+    evaluator = JSONParseEvaluator()
+    samples = list(samples)
+
+    f1, accs, recalls, precisions = [], [], [], []
+    elapsed = 0.0
+
+    for start in range(0, len(samples), batch_size):
+        chunk = samples[start : start + batch_size]
+
+        begin = time.perf_counter()
+        predictions = infer([image for image, _ in chunk])
+        elapsed += time.perf_counter() - begin
+
+        for seq, ground_truth in zip(predictions, [gt for _, gt in chunk]):
+            accs.append(evaluator.cal_acc(seq, ground_truth))
+            f1.append(evaluator.cal_f1(seq, ground_truth))
+
+            total_tp, total_fp, total_fn = 0, 0, 0
+            for pred, answer in zip(seq, ground_truth):
+                pred, answer = evaluator.flatten(
+                    evaluator.normalize_dict(pred)
+                ), evaluator.flatten(evaluator.normalize_dict(answer))
+                answer_set = set(answer)
+                pred_set = set(pred)
+
+                total_tp += len(pred_set & answer_set)
+                total_fp += len(pred_set - answer_set)
+                total_fn += len(answer_set - pred_set)
+
+            precisions.append(
+                total_tp / (total_tp + total_fp) if (total_tp + total_fp) > 0 else 0
+            )
+            recalls.append(
+                total_tp / (total_tp + total_fn) if (total_tp + total_fn) > 0 else 0
+            )
+
+    return {
+        "mean_f1": float(np.mean(f1)),
+        "mean_accuracy": float(np.mean(accs)),
+        "recall": float(np.mean(recalls)),
+        "precisions": float(np.mean(precisions)),
+        "seconds_per_invoice": elapsed / len(samples) if samples else 0.0,
+    }
+
+
+def quantization_guard(
+    inference,
+    samples: Iterable[Tuple[Image.Image, dict]],
+    quantize_encoder: bool = False,
+    batch_size: int = 8,
+    max_f1_drop: float = 0.01,
+    max_accuracy_drop: float = 0.01,
+) -> dict:
+    """Compares fp32 and int8 scores of a `DonutInference`, quantizing it in place.
+
+    Args:
+        inference (DonutInference): An fp32 model on cpu.
+        samples (Iterable): (image, ground truth json) pairs.
+        quantize_encoder (bool): Also quantize the Swin encoder.
+        batch_size (int): Images per generate call.
+        max_f1_drop (float): Largest acceptable drop of mean f1.
+        max_accuracy_drop (float): Largest acceptable drop of mean accuracy.
+
+    Returns:
+        dict: fp32 and int8 scores and whether the int8 model is within tolerance.
+    """
+    samples = list(samples)
+
+    def infer(images):
+        return inference.infer_batch(images, batch_size=batch_size)
+
+    fp32 = evaluate(infer, samples, batch_size=batch_size)
+    inference.quantize(encoder=quantize_encoder)
+    int8 = evaluate(infer, samples, batch_size=batch_size)
+
+    return {
+        "fp32": fp32,
+        "int8": int8,
+        "quantized": inference.quantized,
+        "passed": fp32["mean_f1"] - int8["mean_f1"] <= max_f1_drop
+        and fp32["mean_accuracy"] - int8["mean_accuracy"] <= max_accuracy_drop,
+    }
+
+
+def main():
+    from config import model_name_30, torch_num_threads, torch_num_interop_threads
+    from inference import DonutInference
+
+    parser = argparse.ArgumentParser(
+        description="Check int8 CPU quantization accuracy against fp32."
+    )
+    parser.add_argument("--model", default=model_name_30)
+    parser.add_argument("--limit", type=int, default=50, help="Number of invoices scored.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--quantize-encoder", action="store_true")
+    parser.add_argument("--max-f1-drop", type=float, default=0.01)
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01)
+    args = parser.parse_args()
+
+    inference = DonutInference(
+        model_pth=args.model,
+        device="cpu",
+        num_threads=torch_num_threads,
+        num_interop_threads=torch_num_interop_threads,
+    )
+    report = quantization_guard(
+        inference,
+        load_local_samples(limit=args.limit),
+        quantize_encoder=args.quantize_encoder,
+        batch_size=args.batch_size,
+        max_f1_drop=args.max_f1_drop,
+        max_accuracy_drop=args.max_accuracy_drop,
+    )
+    print(json.dumps(report, indent=2))
+
+    raise SystemExit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import csv
+import json
+import os
+from datetime import date
+
+from sqlalchemy import and_
+
+from src.database_utils import Header, InvoiceDatabase
+from src.results import stream_arrow, stream_query, strip_sql
+
+HEADER_FIELDS = ["invoice_no", "invoice_date", "seller", "client", "seller_tax_id", "client_tax_id", "iban"]
+ITEM_FIELDS = ["line_no", "item_desc", "item_qty", "item_net_price", "item_net_worth", "item_vat", "item_gross_worth"]
+SUMMARY_FIELDS = ["total_net_worth", "total_vat", "total_gross_worth", "totals_match"]
+
+
+def csv_rows(record: dict):
+    """One flat row per item, header and summary repeated, one row for invoices without items."""
+    base = {**record["header"], **record["summary"]}
+    if not record["items"]:
+        yield base
+    for line_no, item in enumerate(record["items"]):
+        yield {**base, "line_no": line_no, **item}
+
+
+def export_records(database: InvoiceDatabase, path: str, format: str = None, **fetch_kwargs) -> int:
+    """Writes invoices from the database to a JSONL or CSV file as they are fetched.
+
+    Args:
+        database (InvoiceDatabase): Database to read.
+        path (str): Output file, overwritten.
+        format (str, optional): "jsonl" or "csv", taken from the file extension when None.
+        **fetch_kwargs: `invoice_nos`, `filter` and `chunk_size` of `InvoiceDatabase.fetch_records`.
+
+    Returns:
+        int: Number of invoices written.
+    """
+    format = format or os.path.splitext(path)[1].lstrip(".").lower()
+    if format not in ("jsonl", "csv"):
+        raise ValueError(f"Unknown export format {format!r}, use jsonl or csv.")
+
+    count = 0
+    with open(path, "w", newline="" if format == "csv" else None) as f:
+        if format == "csv":
+            writer = csv.DictWriter(f, fieldnames=HEADER_FIELDS + ITEM_FIELDS + SUMMARY_FIELDS)
+            writer.writeheader()
+
+        for record in database.fetch_records(**fetch_kwargs):
+            if format == "csv":
+                writer.writerows(csv_rows(record))
+            else:
+                f.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def export_query(query: str, db_url: str, path: str, format: str = None, chunk_size: int = 1000) -> int:
+    """Writes the result of a SELECT to CSV, JSONL or Parquet, one chunk in memory at a time.
+
+    Args:
+        query (str): SQL to run, e.g. a generated query.
+        db_url (str): Connection url of the database.
+        path (str): Output file, overwritten.
+        format (str, optional): "csv", "jsonl" or "parquet", taken from the file extension when None.
+        chunk_size (int): Rows fetched and written at a time.
+
+    Returns:
+        int: Number of rows written.
+    """
+    format = format or os.path.splitext(path)[1].lstrip(".").lower()
+    if format not in ("csv", "jsonl", "parquet"):
+        raise ValueError(f"Unknown export format {format!r}, use csv, jsonl or parquet.")
+    query = strip_sql(query)
+
+    rows = 0
+    if format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for batch in stream_arrow(query, db_url, chunk_size=chunk_size):
+                table = pa.Table.from_batches([batch])
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                elif table.schema != writer.schema:
+                    # a column that was all NULL in the first chunk has no type yet
+                    table = table.cast(writer.schema)
+                writer.write_table(table)
+                rows += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    with open(path, "w", newline="" if format == "csv" else None) as f:
+        for chunk in stream_query(query, db_url, chunk_size=chunk_size):
+            if format == "csv":
+                chunk.to_csv(f, header=rows == 0, index=False)
+            else:
+                for record in chunk.to_dict("records"):
+                    f.write(json.dumps(record, default=str) + "\n")
+            rows += len(chunk)
+    return rows
+
+
+def main():
+    import argparse
+
+    from config import connection_url
+
+    parser = argparse.ArgumentParser(description="Export invoices, or the result of a query, from the database.")
+    parser.add_argument("output", help="File to write, .jsonl or .csv, or .parquet with --query")
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"], help="Defaults to the output extension.")
+    parser.add_argument("--query", help="Export the rows of this SELECT instead of invoices.")
+    parser.add_argument("--invoice-no", nargs="*", help="Only these invoices.")
+    parser.add_argument("--seller", help="Only invoices of this seller.")
+    parser.add_argument("--client", help="Only invoices of this client.")
+    parser.add_argument("--since", help="Only invoices dated on or after this day, YYYY-MM-DD.")
+    parser.add_argument("--until", help="Only invoices dated on or before this day, YYYY-MM-DD.")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--db-url", default=connection_url)
+    args = parser.parse_args()
+
+    if args.query:
+        count = export_query(args.query, args.db_url, args.output, format=args.format, chunk_size=args.chunk_size)
+        print(f"Exported {count} rows to {args.output}")
+        return
+
+    conditions = []
+    if args.seller:
+        conditions.append(Header.seller == args.seller)
+    if args.client:
+        conditions.append(Header.client == args.client)
+    if args.since:
+        conditions.append(Header.invoice_date >= date.fromisoformat(args.since))
+    if args.until:
+        conditions.append(Header.invoice_date <= date.fromisoformat(args.until))
+
+    count = export_records(
+        InvoiceDatabase(args.db_url),
+        args.output,
+        format=args.format,
+        invoice_nos=args.invoice_no,
+        filter=and_(*conditions) if conditions else None,
+        chunk_size=args.chunk_size,
+    )
+    print(f"Exported {count} invoices to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
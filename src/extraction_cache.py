@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ExtractionCache:
+    def __init__(self, path: str, max_entries: int = 50000, enabled: bool = True) -> None:
+        """On-disk cache of Donut outputs backed by a single SQLite file.
+
+        Entries are keyed by (image sha256, model name/revision, generation
+        params) and evicted least-recently-used once `max_entries` is exceeded.
+
+        Args:
+            path (str): Location of the SQLite file, parent folders are created.
+            max_entries (int): Number of outputs kept before the oldest are evicted.
+            enabled (bool): When False every lookup misses and nothing is stored.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if self.enabled:
+            self._connect()
+
+    def _connect(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        # shared by the pipeline threads, access is serialised with self._lock
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extractions (
+                key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS extractions_last_access ON extractions (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image_hash: str, model: str, params: dict) -> str:
+        """Digest of everything that determines the model output."""
+        payload = json.dumps(
+            {"image": image_hash, "model": model, "params": params}, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, image_hash: str, model: str, params: dict) -> dict | None:
+        """Returns the cached output, or None on a miss."""
+        if not self.enabled:
+            return None
+
+        key = self.make_key(image_hash, model, params)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE extractions SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._conn.commit()
+
+        return json.loads(row[0])
+
+    def put(self, image_hash: str, model: str, params: dict, output: dict):
+        """Stores an output and evicts the least recently used entries over the limit."""
+        if not self.enabled:
+            return
+
+        key = self.make_key(image_hash, model, params)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, output, last_access) VALUES (?, ?, ?)",
+                (key, json.dumps(output), time.time()),
+            )
+
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    """
+                    DELETE FROM extractions WHERE key IN (
+                        SELECT key FROM extractions ORDER BY last_access LIMIT ?
+                    )
+                    """,
+                    (overflow,),
+                )
+                self.evictions += overflow
+            self._conn.commit()
+
+    def clear(self):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._conn.execute("DELETE FROM extractions")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process and the current number of entries."""
+        entries = 0
+        if self.enabled:
+            with self._lock:
+                (entries,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM extractions"
+                ).fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import uuid
+from typing import Any, Callable, Iterable, List
+
+from sqlalchemy import select, func
+
+from src.database_utils import IngestJob
+from src.db_pool import engine_pool
+from src.pipeline import IngestPipeline
+
+
+class JobQueue:
+    def __init__(
+        self,
+        database: Any,
+        model_factory: Callable[[], Any],
+        workers: int = 1,
+        claim_size: int = 32,
+        poll_interval: float = 1.0,
+        **pipeline_kwargs,
+    ) -> None:
+        """Background ingest of uploaded files, with state kept in `ingest_jobs`.
+
+        Uploads are enqueued as pending rows. Worker threads claim pending rows,
+        run them through an `IngestPipeline` and record the outcome and stage
+        timings per file, so the UI only has to poll the table.
+
+        Args:
+            database (InvoiceDatabase): Database holding invoices and jobs.
+            model_factory (Callable): Returns the extraction model, called once
+                by the first worker that needs it.
+            workers (int): Number of worker threads.
+            claim_size (int): Max files a worker claims at once.
+            poll_interval (float): Seconds an idle worker sleeps between polls.
+            **pipeline_kwargs: Passed on to `IngestPipeline`.
+        """
+        self.database = database
+        self.model_factory = model_factory
+        self.workers = workers
+        self.claim_size = claim_size
+        self.poll_interval = poll_interval
+        self.pipeline_kwargs = pipeline_kwargs
+
+        self.table = IngestJob.__table__
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._threads = []
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = self.model_factory()
+        return self._model
+
+    def enqueue(self, paths: Iterable[str]) -> str:
+        """Adds files as pending jobs, returns the id of the batch."""
+        batch_id = str(uuid.uuid4())
+        rows = [
+            {
+                "batch_id": batch_id,
+                "filename": os.path.basename(path),
+                "path": path,
+                "status": "pending",
+            }
+            for path in paths
+        ]
+        if rows:
+            with self.database.engine.begin() as connection:
+                connection.execute(self.table.insert(), rows)
+
+        self._wake.set()
+        return batch_id
+
+    def start(self):
+        """Starts the workers, jobs left running by a crashed process are retried."""
+        if self._threads:
+            return
+
+        self.requeue_running()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def requeue_running(self):
+        with self.database.engine.begin() as connection:
+            connection.execute(
+                self.table.update()
+                .where(self.table.c.status == "running")
+                .values(status="pending")
+            )
+
+    def _claim(self) -> List[tuple]:
+        """Marks up to `claim_size` pending jobs as running and returns them."""
+        with self.database.engine.begin() as connection:
+            rows = connection.execute(
+                select(self.table.c.id, self.table.c.path)
+                .where(self.table.c.status == "pending")
+                .order_by(self.table.c.id)
+                .limit(self.claim_size)
+                # concurrent workers skip each other's rows instead of waiting
+                .with_for_update(skip_locked=True)
+            ).fetchall()
+
+            if rows:
+                connection.execute(
+                    self.table.update()
+                    .where(self.table.c.id.in_([job_id for job_id, _ in rows]))
+                    .values(status="running")
+                )
+        return rows
+
+    def _work(self):
+        while not self._stopped.is_set():
+            try:
+                jobs = self._claim()
+            except Exception as e:
+                print(f"Job queue could not claim jobs: {e}")
+                jobs = []
+
+            if not jobs:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+
+            self._process(jobs)
+
+    def _process(self, jobs: List[tuple]):
+        # results are matched back by position, several jobs may share a path
+        ids_by_index = {index: job_id for index, (job_id, _) in enumerate(jobs)}
+
+        try:
+            pipeline = IngestPipeline(
+                inference_model=self.model, database=self.database, **self.pipeline_kwargs
+            )
+            for result in pipeline.run([path for _, path in jobs]):
+                if result.skipped:
+                    status = "skipped"
+                elif result.ok:
+                    status = "done"
+                else:
+                    status = "failed"
+
+                job_id = ids_by_index.pop(result.index, None)
+                if job_id is None:
+                    continue
+                self._finish(
+                    job_id,
+                    status=status,
+                    error=result.error,
+                    invoice_no=(result.data or {}).get("header", {}).get("invoice_no"),
+                    timings=json.dumps(result.timings),
+                )
+        except Exception as e:
+            # whatever the pipeline did not report on failed with it
+            for job_id in ids_by_index.values():
+                self._finish(job_id, status="failed", error=str(e))
+
+    def _finish(self, job_id: int, **values):
+        with self.database.engine.begin() as connection:
+            connection.execute(
+                self.table.update().where(self.table.c.id == job_id).values(**values)
+            )
+
+    def status(self, batch_id: str) -> List[dict]:
+        """Per-file state of a batch, in upload order."""
+        with engine_pool.connect(self.database.uri) as connection:
+            rows = connection.execute(
+                select(
+                    self.table.c.filename,
+                    self.table.c.status,
+                    self.table.c.error,
+                    self.table.c.invoice_no,
+                    self.table.c.timings,
+                )
+                .where(self.table.c.batch_id == batch_id)
+                .order_by(self.table.c.id)
+            ).fetchall()
+
+        return [
+            {
+                "filename": filename,
+                "status": status,
+                "error": error,
+                "invoice_no": invoice_no,
+                "timings": json.loads(timings) if timings else {},
+            }
+            for filename, status, error, invoice_no, timings in rows
+        ]
+
+    def summary(self, batch_id: str) -> dict:
+        """Number of files of a batch per status."""
+        with engine_pool.connect(self.database.uri) as connection:
+            rows = connection.execute(
+                select(self.table.c.status, func.count())
+                .where(self.table.c.batch_id == batch_id)
+                .group_by(self.table.c.status)
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def is_finished(self, batch_id: str) -> bool:
+        counts = self.summary(batch_id)
+        return not counts.get("pending") and not counts.get("running")
@@ -1,6 +1,9 @@
 import re
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import threading
+from collections import OrderedDict
+
+from src.metrics import metrics
+from src.model_registry import model_registry
 
 
 class Singleton(type):
@@ -13,19 +16,139 @@ class Singleton(type):
 
 
 class TextInference(metaclass=Singleton):
-    def __init__(self, model_name: str = "NumbersStation/nsql-350M"):
+    def __init__(
+        self,
+        model_name: str = "NumbersStation/nsql-350M",
+        prefix_cache_size: int = 4,
+        prompt_lookup_num_tokens: int | None = None,
+    ):
+        """Loads the text-to-SQL model.
+
+        Args:
+            model_name (str): Hub name or local folder of a causal LM.
+            prefix_cache_size (int): Number of prompt prefixes (one per schema)
+                whose key/values are kept, 0 disables the prefix cache.
+            prompt_lookup_num_tokens (int, optional): Draft this many tokens by
+                copying n-grams from the prompt, SQL mostly repeats column names.
+        """
+        # imported here, so the query path can use SQLExtractor without torch
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
 
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # hub names are loaded from their pinned snapshot, see src/model_registry.py
+        path = model_registry.resolve(model_name, model_cls=AutoModelForCausalLM)
+        self.tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+
+        self.model = model_registry.load(
+            model_name, AutoModelForCausalLM, mmap_weights=self.device.type == "cpu"
+        ).to(self.device)
+
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+
+        # prompt prefix -> (token ids, past key/values), least recently used first
+        self.prefix_cache_size = prefix_cache_size
+        self._prefixes = OrderedDict()
+        self._prefix_lock = threading.Lock()
+
+    def warmup(self):
+        """Generates a few tokens, so the first question does not pay for lazy init."""
+        input_ids = self.tokenizer("SELECT", return_tensors="pt").input_ids.to(self.device)
+        self.model.generate(input_ids, max_length=input_ids.shape[1] + 4)
+
+    def _prefix_state(self, prefix: str):
+        """Token ids and past key/values of a prompt prefix, computed once per prefix."""
+        import torch
+
+        with self._prefix_lock:
+            if prefix in self._prefixes:
+                self._prefixes.move_to_end(prefix)
+                return self._prefixes[prefix]
+
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.device)
+        with torch.inference_mode(), metrics.timer("prefix_encode_seconds", model="text"):
+            past = self.model(prefix_ids, use_cache=True).past_key_values
+        # generate grows its cache in place, keep immutable tensors instead
+        if hasattr(past, "to_legacy_cache"):
+            past = past.to_legacy_cache()
+
+        with self._prefix_lock:
+            self._prefixes[prefix] = (prefix_ids, past)
+            while len(self._prefixes) > self.prefix_cache_size:
+                self._prefixes.popitem(last=False)
+        return prefix_ids, past
+
+    def _reuse_prefix(self, prefix: str, input_ids):
+        """Past key/values covering all but the last token of `input_ids`, or None.
 
-        self.model = AutoModelForCausalLM.from_pretrained(model_name).to(self.device)
+        The prefix and the full prompt are tokenized separately, so only the
+        leading tokens they agree on are reused, the rest is run on top.
+        """
+        import torch
+
+        prefix_ids, past = self._prefix_state(prefix)
+
+        length = min(prefix_ids.shape[1], input_ids.shape[1] - 1)
+        same = (prefix_ids[0, :length] == input_ids[0, :length]).int()
+        reused = int(same.cumprod(0).sum())
+        metrics.observe("prefix_reused_tokens", reused, model="text")
+        if reused == 0:
+            return None
+
+        past = tuple(tuple(t[:, :, :reused] for t in layer) for layer in past)
+
+        # extend the cache up to the last prompt token, generate feeds that one itself
+        remaining = input_ids[:, reused:-1]
+        if remaining.shape[1]:
+            with torch.inference_mode():
+                past = self.model(remaining, past_key_values=past, use_cache=True).past_key_values
+            if hasattr(past, "to_legacy_cache"):
+                past = past.to_legacy_cache()
+        return past
+
+    def generate_text(self, input_text: str, max_length: int = 500, prefix: str | None = None):
+        """Greedy completion of `input_text`.
+
+        Args:
+            input_text (str): The whole prompt.
+            max_length (int): Max prompt plus generated tokens.
+            prefix (str, optional): Leading part of `input_text` shared by many
+                prompts, e.g. `PromptFormatterV1.prefix()`. Its key/values are
+                cached and reused instead of being recomputed for every prompt.
+        """
+        import torch
 
-    def generate_text(self, input_text: str, max_length: int = 500):
         input_ids = self.tokenizer(input_text, return_tensors="pt").input_ids.to(
             self.device
         )
-        generated_ids = self.model.generate(input_ids, max_length=max_length)
+
+        kwargs = {}
+        if self.prompt_lookup_num_tokens:
+            kwargs["prompt_lookup_num_tokens"] = self.prompt_lookup_num_tokens
+
+        with metrics.timer("generate_seconds", model="text") as timer:
+            if prefix and self.prefix_cache_size and input_text.startswith(prefix):
+                past = self._reuse_prefix(prefix, input_ids)
+                if past is not None:
+                    kwargs["past_key_values"] = past
+
+            with torch.inference_mode():
+                generated_ids = self.model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_length=max_length,
+                    do_sample=False,
+                    pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id,
+                    **kwargs,
+                )
+
+        if metrics.enabled:
+            new_tokens = generated_ids.shape[1] - input_ids.shape[1]
+            metrics.count("generated_tokens_total", new_tokens, model="text")
+            if timer.elapsed > 0:
+                metrics.observe("tokens_per_second", new_tokens / timer.elapsed, model="text")
+
         return self.tokenizer.decode(generated_ids[0], skip_special_tokens=True)
 
 
@@ -33,6 +156,7 @@ class SQLExtractor:
     def __init__(self, text: str):
         self.text = text
 
+    @metrics.timed("sql_extract_seconds")
     def extract_select_commands(self):
         # Regular expression to find all SELECT commands
         select_pattern = re.compile(r"SELECT\s.*?;", re.IGNORECASE | re.DOTALL)
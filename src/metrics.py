@@ -0,0 +1,227 @@
+import functools
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Iterable
+
+
+class LogSink:
+    def __init__(self, logger: logging.Logger | None = None, level: int = logging.INFO) -> None:
+        """Writes one log line per recorded value."""
+        self.logger = logger or logging.getLogger("invoice.metrics")
+        self.level = level
+
+    def record(self, kind: str, name: str, value: float, labels: tuple):
+        if self.logger.isEnabledFor(self.level):
+            extra = " ".join(f"{key}={val}" for key, val in labels)
+            self.logger.log(self.level, "%s %s=%.6g %s", kind, name, value, extra)
+
+    def flush(self, snapshot: dict):
+        pass
+
+
+class MemorySink:
+    def __init__(self, max_events: int = 10000) -> None:
+        """Keeps recent values and the last snapshot in memory, for tests and the UI."""
+        self.events = deque(maxlen=max_events)
+        self.snapshot = {}
+
+    def record(self, kind: str, name: str, value: float, labels: tuple):
+        self.events.append((kind, name, value, dict(labels)))
+
+    def flush(self, snapshot: dict):
+        self.snapshot = snapshot
+
+    def values(self, name: str) -> list:
+        return [value for _, event_name, value, _ in self.events if event_name == name]
+
+
+class PrometheusTextfileSink:
+    def __init__(self, path: str, prefix: str = "invoice_") -> None:
+        """Writes the aggregated series in Prometheus text format on every flush.
+
+        Meant for the node_exporter textfile collector, the file is replaced
+        atomically so a scrape never reads a partial file.
+
+        Args:
+            path (str): Output `.prom` file.
+            prefix (str): Prepended to every metric name.
+        """
+        self.path = path
+        self.prefix = prefix
+
+    def record(self, kind: str, name: str, value: float, labels: tuple):
+        pass
+
+    def flush(self, snapshot: dict):
+        lines = []
+        typed = set()
+        for (kind, name, labels), series in sorted(snapshot.items()):
+            metric = self.prefix + name
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+            label_text = f"{{{label_text}}}" if label_text else ""
+
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} {'counter' if kind == 'counter' else 'summary'}")
+                typed.add(metric)
+
+            if kind == "counter":
+                lines.append(f"{metric}{label_text} {series['sum']:.6g}")
+            else:
+                lines.append(f"{metric}_count{label_text} {series['count']}")
+                lines.append(f"{metric}_sum{label_text} {series['sum']:.6g}")
+
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".prom.tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start", "elapsed")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: dict) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start
+        labels = self.labels
+        if exc_type is not None:
+            labels = {**labels, "error": exc_type.__name__}
+        self.metrics.observe(self.name, self.elapsed, **labels)
+        return False
+
+
+class _NullTimer:
+    """Stand-in returned while metrics are disabled."""
+
+    __slots__ = ()
+    elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False, sinks: Iterable = (), flush_interval: float = 15.0) -> None:
+        """Timers, counters and observed values, aggregated per name and labels.
+
+        While disabled every call returns right after checking `enabled`, so the
+        instrumentation can stay on hot paths.
+
+        Args:
+            enabled (bool): Records nothing when False.
+            sinks (Iterable): Objects with `record(kind, name, value, labels)`
+                and `flush(snapshot)`, e.g. `LogSink` or `PrometheusTextfileSink`.
+            flush_interval (float): Seconds between automatic flushes to the sinks.
+        """
+        self.enabled = enabled
+        self.sinks = list(sinks)
+        self.flush_interval = flush_interval
+
+        self._series = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def timer(self, name: str, **labels):
+        """Context manager observing the seconds spent in its block under `name`."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator version of `timer`."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Timer(self, name, labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe(self, name: str, value: float, **labels):
+        """Records one value of a distribution, e.g. a latency or a batch size."""
+        if self.enabled:
+            self._record("summary", name, value, labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """Adds `value` to a monotonically increasing counter."""
+        if self.enabled:
+            self._record("counter", name, value, labels)
+
+    def _record(self, kind: str, name: str, value: float, labels: dict):
+        labels = tuple(sorted((key, str(val)) for key, val in labels.items()))
+        key = (kind, name, labels)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"count": 0, "sum": 0.0, "min": value, "max": value}
+            series["count"] += 1
+            series["sum"] += value
+            series["min"] = min(series["min"], value)
+            series["max"] = max(series["max"], value)
+
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+
+        for sink in self.sinks:
+            sink.record(kind, name, value, labels)
+
+        if due:
+            self.flush()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: dict(series) for key, series in self._series.items()}
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.flush(snapshot)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _from_config() -> Metrics:
+    from config import metrics_enabled, metrics_log, metrics_textfile, metrics_flush_interval
+
+    sinks = []
+    if metrics_log:
+        sinks.append(LogSink())
+    if metrics_textfile:
+        sinks.append(PrometheusTextfileSink(metrics_textfile))
+    return Metrics(enabled=metrics_enabled, sinks=sinks, flush_interval=metrics_flush_interval)
+
+
+# process wide registry, shared by every instrumented module
+metrics = _from_config()
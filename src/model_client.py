@@ -0,0 +1,81 @@
+import base64
+import json
+import urllib.error
+import urllib.request
+from io import BytesIO
+from typing import Iterable, List
+
+
+class ModelClient:
+    def __init__(self, base_url: str, timeout: float = 600) -> None:
+        """Thin client of `model_server.py`.
+
+        Mirrors the `DonutInference` and `TextInference` call signatures so the
+        UI and batch scripts can use either a local model or the server.
+
+        Args:
+            base_url (str): Server address, e.g. http://127.0.0.1:8765.
+            timeout (float): Seconds to wait for a response.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _post(self, path: str, payload: dict) -> dict:
+        request = urllib.request.Request(
+            f"{self.base_url}{path}",
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Model server error: {e.read().decode()}") from e
+
+    def health(self) -> bool:
+        try:
+            with urllib.request.urlopen(f"{self.base_url}/health", timeout=5) as response:
+                return json.loads(response.read()).get("status") == "ok"
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def stats(self) -> dict:
+        """Scheduler queue depth, batch sizes and latency percentiles of the server."""
+        with urllib.request.urlopen(f"{self.base_url}/stats", timeout=5) as response:
+            return json.loads(response.read())
+
+    def extract(self, contents: Iterable[bytes], image_hashes: Iterable = None) -> List[dict]:
+        """Parses raw image files on the server, one json per image.
+
+        The server hashes the bytes itself, `image_hashes` is accepted for
+        signature compatibility with the local pipeline only.
+        """
+        images = [base64.b64encode(content).decode() for content in contents]
+        return self._post("/extract", {"images": images})["results"]
+
+    def infer_batch(self, images: Iterable, batch_size: int = 8, image_hashes: Iterable = None) -> List[dict]:
+        """Same as `DonutInference.infer_batch`, PIL images are sent as PNG."""
+        contents = []
+        for image in images:
+            buffer = BytesIO()
+            image.save(buffer, format="PNG")
+            contents.append(buffer.getvalue())
+
+        # the server batches internally, split only to bound the request size
+        results = []
+        for start in range(0, len(contents), batch_size):
+            results.extend(self.extract(contents[start : start + batch_size]))
+        return results
+
+    def __call__(self, image) -> dict:
+        return self.infer_batch([image], batch_size=1)[0]
+
+    def cache_lookup(self, image_hash: str) -> None:
+        # the extraction cache lives on the server
+        return None
+
+    def generate_text(self, input_text: str, max_length: int = 500, prefix: str | None = None) -> str:
+        """Same as `TextInference.generate_text`."""
+        return self._post(
+            "/sql", {"prompts": [input_text], "max_length": max_length, "prefix": prefix}
+        )["outputs"][0]
@@ -0,0 +1,271 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+# files of a snapshot that loading needs, the rest of a hub repo is skipped
+_SNAPSHOT_PATTERNS = ["*.json", "*.txt", "*.model", "*.safetensors", "*.bin"]
+
+# safetensors dtype names to torch dtype attribute names
+_SAFETENSORS_DTYPES = {
+    "F64": "float64",
+    "F32": "float32",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool",
+}
+
+
+def mmap_safetensors(path: str) -> dict:
+    """Tensors of a `.safetensors` file as read-only views on a shared memory map.
+
+    Unlike a normal load nothing is copied, so processes mapping the same file
+    share its pages through the page cache.
+
+    Args:
+        path (str): A `.safetensors` file.
+
+    Returns:
+        dict: Maps tensor names to CPU tensors backed by the file.
+    """
+    import warnings
+
+    import torch
+
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (header_size,) = struct.unpack("<Q", buffer[:8])
+    header = json.loads(buffer[8 : 8 + header_size])
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+
+    tensors = {}
+    with warnings.catch_warnings():
+        # the map is read only, weights are never written in eval mode
+        warnings.filterwarnings("ignore", message="The given buffer is not writable")
+        for name, info in header.items():
+            dtype = getattr(torch, _SAFETENSORS_DTYPES[info["dtype"]])
+            begin, end = info["data_offsets"]
+            if begin == end:
+                tensors[name] = torch.empty(info["shape"], dtype=dtype)
+                continue
+            flat = torch.frombuffer(
+                buffer,
+                dtype=dtype,
+                count=(end - begin) // torch.tensor([], dtype=dtype).element_size(),
+                offset=data_start + begin,
+            )
+            tensors[name] = flat.reshape(info["shape"])
+    return tensors
+
+
+class ModelRegistry:
+    def __init__(self, root: str, revisions: dict | None = None, offline: bool = False) -> None:
+        """Resolves hub model names to pinned, local safetensors snapshots.
+
+        A model is downloaded once per revision into `root`, converted to
+        safetensors when the hub only has `.bin` weights, and recorded in
+        `root/registry.json`. Later resolves only read the disk, so workers
+        start offline and always load the same weights.
+
+        Args:
+            root (str): Folder holding the snapshots.
+            revisions (dict, optional): Maps model names to the hub revision to
+                pin, names that are not listed pin whatever `main` points to.
+            offline (bool): Never contact the hub, unpinned models fail to resolve.
+        """
+        self.root = root
+        self.revisions = revisions or {}
+        self.offline = offline
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.root, "registry.json")
+
+    def manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def revision(self, name: str) -> str | None:
+        """Revision a model is pinned at, None for local folders and unpinned names."""
+        entry = self.manifest().get(name)
+        return entry["revision"] if entry else None
+
+    def resolve(self, name: str, model_cls=None) -> str:
+        """Local folder to load `name` from, pinning it first when needed.
+
+        Args:
+            name (str): Hub name, or a local folder which is returned as is.
+            model_cls (type, optional): Model class, used to convert `.bin`
+                weights to safetensors while pinning.
+        """
+        if os.path.isdir(name):
+            return name
+
+        entry = self.manifest().get(name)
+        wanted = self.revisions.get(name)
+        if entry and os.path.isdir(entry["path"]) and wanted in (None, entry["revision"]):
+            return entry["path"]
+
+        if self.offline:
+            raise FileNotFoundError(
+                f"{name} has no local snapshot, pin it while online with: "
+                f"python -m src.model_registry pin {name}"
+            )
+        return self.pin(name, model_cls=model_cls)
+
+    def pin(self, name: str, model_cls=None) -> str:
+        """Downloads the configured revision of `name` and records it as pinned."""
+        from huggingface_hub import HfApi, snapshot_download
+
+        with self._lock:
+            revision = HfApi().model_info(name, revision=self.revisions.get(name)).sha
+            path = os.path.join(self.root, name.replace("/", "--"), revision)
+
+            if not os.path.isdir(path):
+                tmp_path = f"{path}.tmp"
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                snapshot_download(
+                    repo_id=name,
+                    revision=revision,
+                    local_dir=tmp_path,
+                    allow_patterns=_SNAPSHOT_PATTERNS,
+                )
+                self._ensure_safetensors(tmp_path, model_cls)
+                os.replace(tmp_path, path)
+
+            manifest = self.manifest()
+            manifest[name] = {"revision": revision, "path": path}
+            self._write_manifest(manifest)
+        return path
+
+    @staticmethod
+    def _ensure_safetensors(path: str, model_cls):
+        if any(name.endswith(".safetensors") for name in os.listdir(path)):
+            return
+        if model_cls is None:
+            return
+
+        model = model_cls.from_pretrained(path, local_files_only=True)
+        model.save_pretrained(path, safe_serialization=True)
+        for name in os.listdir(path):
+            if name.endswith(".bin") and name.startswith("pytorch_model"):
+                os.remove(os.path.join(path, name))
+
+    def load(self, name: str, model_cls, mmap_weights: bool = True):
+        """Loads a pinned model, with weights memory-mapped from its safetensors.
+
+        Args:
+            name (str): Hub name or local folder.
+            model_cls (type): A transformers model class, e.g. `VisionEncoderDecoderModel`.
+            mmap_weights (bool): Back the parameters by the shared file mapping,
+                only sensible for CPU models that are not modified afterwards.
+        """
+        path = self.resolve(name, model_cls=model_cls)
+
+        weights = sorted(
+            os.path.join(path, file) for file in os.listdir(path) if file.endswith(".safetensors")
+        )
+        if not mmap_weights or not weights:
+            return model_cls.from_pretrained(path, local_files_only=True)
+
+        from transformers import AutoConfig, PreTrainedModel
+        from transformers.modeling_utils import no_init_weights
+
+        config = AutoConfig.from_pretrained(path, local_files_only=True)
+        # the weights are replaced right away, skip the random initialisation
+        with no_init_weights():
+            model = getattr(model_cls, "from_config", model_cls)(config)
+
+        state_dict = {}
+        for file in weights:
+            state_dict.update(mmap_safetensors(file))
+
+        # assign swaps the empty parameters for the mapped tensors instead of copying
+        missing, _ = model.load_state_dict(state_dict, strict=False, assign=True)
+
+        # composite models (VisionEncoderDecoderModel) do not tie their parts
+        # themselves, e.g. the decoder lm_head is left out of the saved file
+        for module in model.modules():
+            if isinstance(module, PreTrainedModel):
+                module.tie_weights()
+
+        # tied weights are saved once, they are fine as long as they now share a loaded tensor
+        loaded = {tensor.data_ptr() for tensor in state_dict.values()}
+        current = model.state_dict()
+        missing = [key for key in missing if current[key].data_ptr() not in loaded]
+        if missing:
+            raise ValueError(f"{name}: weights missing from the snapshot: {missing[:5]}")
+        return model.eval()
+
+
+def warm_up(model):
+    """Calls the model's `warmup` hook, if it has one."""
+    hook = getattr(model, "warmup", None)
+    if hook is not None:
+        hook()
+    return model
+
+
+def _from_config() -> ModelRegistry:
+    from config import model_registry_dir, model_registry_offline, model_revisions
+
+    return ModelRegistry(
+        root=model_registry_dir,
+        revisions=model_revisions,
+        offline=model_registry_offline or os.environ.get("HF_HUB_OFFLINE") == "1",
+    )
+
+
+# process wide registry, resolved names are shared by every loader
+model_registry = _from_config()
+
+
+def main():
+    import argparse
+
+    from config import model_name_10, model_name_30, model_name_base, text_model_name
+
+    parser = argparse.ArgumentParser(description="Pin model snapshots for offline loading.")
+    parser.add_argument("command", choices=["pin", "list"])
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="Models to pin, defaults to every model named in config.py.",
+    )
+    args = parser.parse_args()
+
+    if args.command == "list":
+        print(json.dumps(model_registry.manifest(), indent=2))
+        return
+
+    from transformers import AutoModelForCausalLM, VisionEncoderDecoderModel
+
+    donut_models = [model_name_10, model_name_30, model_name_base]
+    for name in args.names or donut_models + [text_model_name]:
+        model_cls = VisionEncoderDecoderModel if name in donut_models else AutoModelForCausalLM
+        print(f"{name} -> {model_registry.pin(name, model_cls=model_cls)}")
+
+
+if __name__ == "__main__":
+    main()
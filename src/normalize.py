@@ -0,0 +1,214 @@
+from dataclasses import dataclass, field
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from src.metrics import metrics
+
+ITEM_AMOUNTS = ("item_qty", "item_net_price", "item_net_worth", "item_gross_worth")
+ITEM_PERCENTS = ("item_vat",)
+SUMMARY_AMOUNTS = ("total_net_worth", "total_vat", "total_gross_worth")
+
+# decimal separator assumed when neither the value nor its invoice tells, the invoices use "1 234,56"
+DEFAULT_DECIMAL = ","
+
+
+def _decimal_hints(cleaned: pd.Series) -> pd.Series:
+    """Decimal separator of every value, NA when the value alone does not tell.
+
+    "1.234,56" and "1,234.56" are decided by the last separator, "12,5" and
+    "12.50" by the digit count after it, while "1,234" and "1.234" could be
+    either and stay NA. Several separators of one kind ("1,234,567") mean
+    there is no decimal part, marked as "".
+    """
+    commas = cleaned.str.count(",").fillna(0)
+    dots = cleaned.str.count(r"\.").fillna(0)
+    last = cleaned.str.extract(r"([.,])\d*$")[0]
+    tail = cleaned.str.extract(r"[.,](\d*)$")[0].str.len().fillna(-1)
+
+    hints = pd.Series(pd.NA, index=cleaned.index, dtype="object")
+
+    both = (commas > 0) & (dots > 0)
+    hints[both] = last[both]
+
+    single = ~both & ((commas + dots) == 1)
+    hints[single & (tail != 3)] = last[single & (tail != 3)]
+
+    repeated = ~both & ((commas > 1) | (dots > 1))
+    hints[repeated] = ""
+    return hints
+
+
+def detect_decimal_separator(values: Iterable, default: str = DEFAULT_DECIMAL) -> str:
+    """Most common unambiguous decimal separator of `values`, `default` if there is none."""
+    cleaned = pd.Series(list(values), dtype="string").str.replace(r"[^\d,.\-]", "", regex=True)
+    hints = _decimal_hints(cleaned)
+    hints = hints[hints.isin([",", "."])]
+    return hints.mode().iloc[0] if not hints.empty else default
+
+
+def parse_numbers(values, decimal: pd.Series | str | None = None) -> pd.Series:
+    """Parses money, quantity and percent strings column-wise.
+
+    Currency symbols, letters, spaces and a trailing `%` are dropped, the
+    thousands separator is removed and the decimal separator becomes ".".
+    Values whose separator is ambiguous, like "1,234", use `decimal`.
+
+    Args:
+        values: Strings (or numbers, or None) to parse.
+        decimal (Series or str, optional): Separator for ambiguous values, per
+            value or for all of them, detected from `values` when None.
+
+    Returns:
+        pd.Series: Floats, NaN where nothing could be parsed.
+    """
+    series = pd.Series(values, dtype="object")
+    index = series.index
+
+    cleaned = series.astype("string").str.replace(r"[^\d,.\-]", "", regex=True)
+    hints = _decimal_hints(cleaned)
+
+    if decimal is None:
+        decimal = detect_decimal_separator(cleaned.dropna())
+    if isinstance(decimal, str):
+        decimal = pd.Series(decimal, index=index, dtype="object")
+    hints = hints.fillna(decimal).fillna(DEFAULT_DECIMAL)
+
+    comma_decimal = hints == ","
+    dot_decimal = hints == "."
+
+    normalized = cleaned.copy()
+    normalized[comma_decimal] = (
+        cleaned[comma_decimal].str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    )
+    normalized[dot_decimal] = cleaned[dot_decimal].str.replace(",", "", regex=False)
+    no_decimal = ~(comma_decimal | dot_decimal)
+    normalized[no_decimal] = cleaned[no_decimal].str.replace(r"[.,]", "", regex=True)
+
+    return pd.to_numeric(normalized, errors="coerce").astype("float64")
+
+
+@dataclass
+class NormalizedInvoices:
+    """Item and summary numbers of a batch of parsed invoices."""
+
+    # one row per item, `record` is the index of the invoice in the batch
+    items: pd.DataFrame
+    # one row per invoice that could be normalized
+    summary: pd.DataFrame
+    # record index -> why the invoice could not be read at all
+    failures: dict = field(default_factory=dict)
+    # record index -> which totals disagree with the sum of the items, also
+    # flagged as `totals_match` False in `summary`
+    mismatches: dict = field(default_factory=dict)
+
+    def by_record(self) -> dict:
+        """Maps every normalized record index to its (item dicts, summary dict).
+
+        NaN becomes None, the `record` column is dropped.
+        """
+        rows = {record: ([], summary) for record, summary in _records(self.summary)}
+        for record, item in _records(self.items):
+            rows[record][0].append(item)
+        return rows
+
+
+def _records(frame: pd.DataFrame) -> list:
+    """(record, row dict) pairs of `frame`, with NaN turned into None."""
+    frame = frame.astype(object).where(frame.notna(), None)
+    return [(row.pop("record"), row) for row in frame.to_dict("records")]
+
+
+def normalize_invoices(records: Iterable[dict], tolerance: float = 0.01) -> NormalizedInvoices:
+    """Parses the item and summary fields of many invoices in one vectorized pass.
+
+    Ambiguous values are read with the decimal separator the rest of their
+    invoice uses, so one invoice in "1,234.56" style does not change how the
+    others are read.
+
+    Args:
+        records (Iterable[dict]): Parsed invoices with `items` and `summary`.
+        tolerance (float): Relative difference allowed between a summary total
+            and the sum of the item values before the invoice is flagged.
+    """
+    item_rows, summary_rows, failures = [], [], {}
+
+    for idx, data in enumerate(records):
+        try:
+            items = [
+                {
+                    "record": idx,
+                    "line_no": line_no,
+                    "item_desc": item["item_desc"],
+                    **{column: item[column] for column in ITEM_AMOUNTS + ITEM_PERCENTS},
+                }
+                for line_no, item in enumerate(data["items"])
+            ]
+            summary = {
+                "record": idx,
+                **{column: data["summary"][column] for column in SUMMARY_AMOUNTS},
+            }
+        except (KeyError, TypeError, AttributeError) as e:
+            failures[idx] = f"malformed record: {e!r}"
+            continue
+        item_rows.extend(items)
+        summary_rows.append(summary)
+
+    items = pd.DataFrame(item_rows, columns=["record", "line_no", "item_desc", *ITEM_AMOUNTS, *ITEM_PERCENTS])
+    summary = pd.DataFrame(summary_rows, columns=["record", *SUMMARY_AMOUNTS])
+
+    # separator each invoice uses, from its own unambiguous values
+    raw = pd.concat(
+        [
+            items.melt(id_vars="record", value_vars=[*ITEM_AMOUNTS, *ITEM_PERCENTS])[["record", "value"]],
+            summary.melt(id_vars="record", value_vars=list(SUMMARY_AMOUNTS))[["record", "value"]],
+        ],
+        ignore_index=True,
+    )
+    raw["hint"] = _decimal_hints(
+        raw["value"].astype("string").str.replace(r"[^\d,.\-]", "", regex=True)
+    )
+    known = raw[raw["hint"].isin([",", "."])]
+    batch_decimal = known["hint"].mode().iloc[0] if not known.empty else DEFAULT_DECIMAL
+    per_record = known.groupby("record")["hint"].agg(lambda hints: hints.mode().iloc[0])
+
+    for frame, columns in ((items, ITEM_AMOUNTS + ITEM_PERCENTS), (summary, SUMMARY_AMOUNTS)):
+        decimal = frame["record"].map(per_record).fillna(batch_decimal)
+        for column in columns:
+            frame[column] = parse_numbers(frame[column], decimal=decimal)
+
+    mismatches = _check_totals(items, summary, tolerance)
+    if mismatches:
+        metrics.count("invoice_totals_mismatch_total", len(mismatches))
+
+    return NormalizedInvoices(items=items, summary=summary, failures=failures, mismatches=mismatches)
+
+
+def _check_totals(items: pd.DataFrame, summary: pd.DataFrame, tolerance: float) -> dict:
+    """Invoices whose summary totals differ from the sum of their items.
+
+    Sets `summary["totals_match"]`, None where no total could be compared.
+    """
+    sums = items.groupby("record")[["item_net_worth", "item_gross_worth"]].sum(min_count=1)
+    joined = summary.set_index("record").join(sums, how="left")
+
+    mismatches = {}
+    checked = pd.Series(False, index=joined.index)
+    for total, column in (("total_net_worth", "item_net_worth"), ("total_gross_worth", "item_gross_worth")):
+        expected = joined[total]
+        actual = joined[column]
+        limit = tolerance * np.maximum(expected.abs(), 1.0)
+        comparable = expected.notna() & actual.notna()
+        checked |= comparable
+        wrong = comparable & ((expected - actual).abs() > limit)
+        for record in joined.index[wrong]:
+            mismatches.setdefault(int(record), []).append(
+                f"{total} {expected[record]:.2f} != items {actual[record]:.2f}"
+            )
+
+    match = pd.Series(True, index=joined.index, dtype="object")
+    match.loc[~checked] = None
+    match.loc[list(mismatches)] = False
+    summary["totals_match"] = summary["record"].map(match)
+    return {record: "; ".join(messages) for record, messages in mismatches.items()}
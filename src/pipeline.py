@@ -0,0 +1,368 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, List
+
+from src.utils import LOOPED_KEY, bytes_sha256
+
+
+# marks the end of the stream on every queue
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    """Timing counters for one pipeline stage."""
+
+    name: str
+    items: int = 0
+    batches: int = 0
+    errors: int = 0
+    skipped: int = 0
+    # time spent doing the actual work of the stage
+    busy_seconds: float = 0.0
+    # time spent waiting on the upstream queue (stage starved)
+    idle_seconds: float = 0.0
+    # time spent blocked on a full downstream queue (backpressure)
+    blocked_seconds: float = 0.0
+    max_queue_depth: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def observe_depth(self, depth: int):
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def as_dict(self) -> dict:
+        return {
+            "items": self.items,
+            "batches": self.batches,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "busy_seconds": round(self.busy_seconds, 4),
+            "idle_seconds": round(self.idle_seconds, 4),
+            "blocked_seconds": round(self.blocked_seconds, 4),
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+@dataclass
+class IngestResult:
+    """Outcome of one image going through the pipeline."""
+
+    path: str
+    # position of the image in the sources given to `run`, tells apart
+    # sources that share a path
+    index: int | None = None
+    data: dict | None = None
+    error: str | None = None
+    image_hash: str | None = None
+    # set when the image was ingested before and inference was skipped
+    skipped: bool = False
+    # seconds spent on this image per stage, batched stages are split evenly
+    timings: dict = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        inference_model: Any,
+        database: Any,
+        decode_workers: int = 4,
+        batch_size: int = 8,
+        commit_every: int = 32,
+        queue_size: int = 64,
+        pixel_cache_dir: str | None = None,
+    ) -> None:
+        """Streams images through decode -> model -> database stages.
+
+        Every stage runs on its own thread(s) and hands work over bounded
+        queues, so a slow stage blocks the ones feeding it instead of
+        buffering the whole upload in memory.
+
+        Args:
+            inference_model (Any): A `DonutInference`, used through its
+                `processor` and `submit(pixel_values)`, or a `ModelClient`,
+                in which case raw image bytes are sent to the model server.
+            database (Any): An `InvoiceDatabase` the parsed invoices are written to.
+            decode_workers (int): Threads decoding and preprocessing images.
+            batch_size (int): Max number of images per generate call.
+            commit_every (int): Number of invoices written per transaction.
+            queue_size (int): Capacity of each inter-stage queue.
+            pixel_cache_dir (str, optional): Keeps preprocessed pixel values on
+                disk by image hash, so re-runs skip decode and resize.
+        """
+        self.inference_model = inference_model
+        self.database = database
+        self.decode_workers = decode_workers
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.queue_size = queue_size
+
+        # a model server client preprocesses on the server side
+        self.remote = not hasattr(inference_model, "processor")
+        self.preprocessor = None
+        if not self.remote:
+            from src.preprocess import Preprocessor
+
+            self.preprocessor = Preprocessor(
+                inference_model.processor, cache_dir=pixel_cache_dir
+            )
+
+        self.stats = self._new_stats()
+
+        self._seen_hashes = set()
+        self._seen_lock = threading.Lock()
+
+    def run(self, sources: Iterable) -> Iterator[IngestResult]:
+        """Runs the pipeline and yields one result per image once it is committed.
+
+        Args:
+            sources (Iterable): Image file paths, or (name, bytes) pairs for
+                images that are already in memory, e.g. fresh uploads.
+        """
+
+        decoded = queue.Queue(maxsize=self.queue_size)
+        parsed = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue()
+        self.stats = self._new_stats()
+        self._seen_hashes = set()
+
+        threads = [
+            threading.Thread(target=self._decode_stage, args=(list(sources), decoded, parsed, results)),
+            threading.Thread(target=self._model_stage, args=(decoded, parsed, results)),
+            threading.Thread(target=self._write_stage, args=(parsed, results)),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # the writer is the last one to finish, it closes the results stream
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            yield result
+
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _new_stats() -> dict:
+        return {name: StageStats(name=name) for name in ("decode", "model", "write")}
+
+    def report(self) -> dict:
+        """Per-stage timings and backpressure counters of the last run."""
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
+
+    def _put(self, q: queue.Queue, item, stats: StageStats):
+        start = time.perf_counter()
+        q.put(item)
+        stats.add(blocked_seconds=time.perf_counter() - start)
+        stats.observe_depth(q.qsize())
+
+    def _get(self, q: queue.Queue, stats: StageStats):
+        start = time.perf_counter()
+        item = q.get()
+        stats.add(idle_seconds=time.perf_counter() - start)
+        return item
+
+    def _decode_one(
+        self,
+        index: int,
+        source,
+        decoded: queue.Queue,
+        parsed: queue.Queue,
+        results: queue.Queue,
+    ):
+        stats = self.stats["decode"]
+        start = time.perf_counter()
+        path = source if isinstance(source, str) else source[0]
+        try:
+            if isinstance(source, str):
+                with open(path, "rb") as f:
+                    content = f.read()
+            else:
+                content = source[1]
+            image_hash = bytes_sha256(content)
+
+            # skip images already ingested, or already queued in this run
+            with self._seen_lock:
+                duplicate = image_hash in self._seen_hashes
+                self._seen_hashes.add(image_hash)
+            known = {} if duplicate else self.database.known_hashes([image_hash])
+            if duplicate or known:
+                elapsed = time.perf_counter() - start
+                stats.add(skipped=1, busy_seconds=elapsed)
+                results.put(
+                    IngestResult(
+                        path=path,
+                        index=index,
+                        data={"header": {"invoice_no": known.get(image_hash)}},
+                        image_hash=image_hash,
+                        skipped=True,
+                        timings={"decode": elapsed},
+                    )
+                )
+                return
+
+            # a cached extraction goes straight to the writer, the model never sees it
+            cached = self.inference_model.cache_lookup(image_hash)
+            if cached is not None:
+                elapsed = time.perf_counter() - start
+                stats.add(items=1, busy_seconds=elapsed)
+                self._put(parsed, (index, path, image_hash, cached, {"decode": elapsed}), stats)
+                return
+
+            if self.remote:
+                pixel_values = content
+            else:
+                pixel_values = self.preprocessor(content, image_hash=image_hash)
+        except Exception as e:
+            stats.add(errors=1)
+            results.put(IngestResult(path=path, index=index, error=f"decode failed: {e}"))
+            return
+        elapsed = time.perf_counter() - start
+        stats.add(items=1, busy_seconds=elapsed)
+
+        self._put(decoded, (index, path, image_hash, pixel_values, {"decode": elapsed}), stats)
+
+    def _decode_stage(
+        self,
+        sources: List,
+        decoded: queue.Queue,
+        parsed: queue.Queue,
+        results: queue.Queue,
+    ):
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as pool:
+            for index, source in enumerate(sources):
+                pool.submit(self._decode_one, index, source, decoded, parsed, results)
+        self._put(decoded, _DONE, self.stats["decode"])
+
+    def _model_stage(self, decoded: queue.Queue, parsed: queue.Queue, results: queue.Queue):
+        stats = self.stats["model"]
+        done = False
+
+        while not done:
+            # block for the first image, then drain whatever is ready up to batch_size
+            item = self._get(decoded, stats)
+            if item is _DONE:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = decoded.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            start = time.perf_counter()
+            image_hashes = [image_hash for _, _, image_hash, _, _ in batch]
+            try:
+                if self.remote:
+                    outputs = self.inference_model.extract(
+                        [content for _, _, _, content, _ in batch], image_hashes=image_hashes
+                    )
+                else:
+                    # the model's scheduler batches these with other pipelines and callers
+                    futures = [
+                        self.inference_model.submit(pixel_values, image_hash=image_hash)
+                        for _, _, image_hash, pixel_values, _ in batch
+                    ]
+                    outputs = [future.result() for future in futures]
+            except Exception as e:
+                stats.add(errors=len(batch))
+                for index, path, image_hash, _, timings in batch:
+                    results.put(
+                        IngestResult(
+                            path=path,
+                            index=index,
+                            image_hash=image_hash,
+                            error=f"inference failed: {e}",
+                            timings=timings,
+                        )
+                    )
+                continue
+            elapsed = time.perf_counter() - start
+            stats.add(items=len(batch), batches=1, busy_seconds=elapsed)
+
+            for (index, path, image_hash, _, timings), data in zip(batch, outputs):
+                timings["model"] = elapsed / len(batch)
+                if isinstance(data, dict) and data.get(LOOPED_KEY):
+                    stats.add(errors=1)
+                    results.put(
+                        IngestResult(
+                            path=path,
+                            index=index,
+                            data=data,
+                            image_hash=image_hash,
+                            error="inference failed: the decoder looped, output not trusted",
+                            timings=timings,
+                        )
+                    )
+                    continue
+                self._put(parsed, (index, path, image_hash, data, timings), stats)
+
+        self._put(parsed, _DONE, stats)
+
+    def _write_stage(self, parsed: queue.Queue, results: queue.Queue):
+        stats = self.stats["write"]
+        pending = []
+
+        while True:
+            item = self._get(parsed, stats)
+            if item is not _DONE:
+                pending.append(item)
+            if pending and (item is _DONE or len(pending) >= self.commit_every):
+                self._flush(pending, results)
+                pending = []
+            if item is _DONE:
+                break
+
+        results.put(_DONE)
+
+    def _flush(self, pending: list, results: queue.Queue):
+        """Writes a group of invoices in one transaction."""
+        stats = self.stats["write"]
+        start = time.perf_counter()
+        try:
+            failures = self.database.push_many(
+                [data for _, _, _, data, _ in pending],
+                image_hashes=[image_hash for _, _, image_hash, _, _ in pending],
+            )
+        except Exception as e:
+            failures = {idx: str(e) for idx in range(len(pending))}
+        elapsed = time.perf_counter() - start
+        stats.add(
+            items=len(pending) - len(failures),
+            errors=len(failures),
+            batches=1,
+            busy_seconds=elapsed,
+        )
+
+        for idx, (index, path, image_hash, data, timings) in enumerate(pending):
+            timings["write"] = elapsed / len(pending)
+            error = failures.get(idx)
+            results.put(
+                IngestResult(
+                    path=path,
+                    index=index,
+                    data=data,
+                    image_hash=image_hash,
+                    error=f"write failed: {error}" if error else None,
+                    timings=timings,
+                )
+            )
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import tempfile
+from io import BytesIO
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.metrics import metrics
+
+
+def open_image(content: bytes, target_size: tuple | None = None) -> Image.Image:
+    """Decodes an image file, letting JPEG decode straight to a smaller scale.
+
+    JPEG draft mode makes libjpeg decode at 1/2, 1/4 or 1/8 scale, picking the
+    smallest one that still covers `target_size`, so full-resolution scans
+    are never materialised when the model only needs a fraction of them.
+
+    Args:
+        content (bytes): Raw image file.
+        target_size (tuple, optional): (width, height) the image will be resized to.
+
+    Returns:
+        Image.Image: RGB image, at least `target_size` large when it was bigger.
+    """
+    img = Image.open(BytesIO(content))
+    if target_size and img.format == "JPEG":
+        img.draft("RGB", target_size)
+    return img.convert("RGB")
+
+
+class PixelCache:
+    def __init__(self, root: str) -> None:
+        """Stores normalized pixel values as float16 `.npy` files keyed by image hash.
+
+        Arrays are loaded memory-mapped, so warm reads skip decode and resize
+        and only touch the pages that are actually used.
+
+        Args:
+            root (str): Folder holding one file per image.
+        """
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, image_hash: str) -> str:
+        return os.path.join(self.root, image_hash[:2], f"{image_hash}.npy")
+
+    def get(self, image_hash: str) -> np.ndarray | None:
+        try:
+            return np.load(self._path(image_hash), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, image_hash: str, pixel_values: np.ndarray):
+        path = self._path(image_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temp file first so readers never see a partial array
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, pixel_values.astype(np.float16))
+        os.replace(tmp_path, path)
+
+
+class Preprocessor:
+    def __init__(self, processor, cache_dir: str | None = None) -> None:
+        """Turns raw image files into Donut `pixel_values`.
+
+        Args:
+            processor (DonutProcessor): Processor of the model.
+            cache_dir (str, optional): Root of the pixel cache, None disables it.
+        """
+        self.processor = processor
+
+        size = processor.image_processor.size
+        side = max(size["height"], size["width"])
+        # the processor may rotate to align the long axis, cover both orientations
+        self.target_size = (side, side)
+
+        self.cache = None
+        if cache_dir:
+            # processor settings decide the tensor, keep each config in its own folder
+            signature = hashlib.sha256(
+                json.dumps(processor.image_processor.to_dict(), sort_keys=True, default=str).encode()
+            ).hexdigest()[:12]
+            self.cache = PixelCache(os.path.join(cache_dir, signature))
+
+    def __call__(self, content: bytes, image_hash: str | None = None) -> torch.Tensor:
+        """Pixel values of one image, shaped (channels, height, width)."""
+        if self.cache is not None and image_hash:
+            cached = self.cache.get(image_hash)
+            if cached is not None:
+                return torch.from_numpy(np.asarray(cached, dtype=np.float32))
+
+        with metrics.timer("decode_seconds"):
+            image = open_image(content, self.target_size)
+        with metrics.timer("preprocess_seconds"):
+            pixel_values = self.processor(image, return_tensors="pt").pixel_values[0]
+
+        if self.cache is not None and image_hash:
+            self.cache.put(image_hash, pixel_values.numpy())
+
+        return pixel_values
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable
+
+from src.db_models import Table
+
+
+def normalize_question(question: str) -> str:
+    """Lowercases a question and drops whitespace/punctuation noise around it."""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?.!;")
+
+
+def schema_fingerprint(tables: Iterable[Table]) -> str:
+    """Digest of the schema as returned by `DatabaseAgent.grab_table_schema`."""
+    payload = json.dumps(
+        sorted((table.dict() for table in tables), key=lambda table: table["name"]),
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class _LRU:
+    """Small thread-safe LRU mapping."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class QueryCache:
+    def __init__(self, max_sql_entries: int = 512, max_result_entries: int = 64) -> None:
+        """Two level cache for the question -> SQL -> DataFrame path.
+
+        Generated SQL is keyed by the normalized question and the schema
+        fingerprint, so it is regenerated when the tables change. Results are
+        keyed by the SQL text and the database data version, which every
+        `InvoiceDatabase` write bumps, so stale results are never served.
+
+        Args:
+            max_sql_entries (int): Number of generated SQL statements kept.
+            max_result_entries (int): Number of result DataFrames kept.
+        """
+        self.sql = _LRU(max_sql_entries)
+        self.results = _LRU(max_result_entries)
+
+    def get_sql(self, question: str, fingerprint: str) -> str | None:
+        return self.sql.get((normalize_question(question), fingerprint))
+
+    def put_sql(self, question: str, fingerprint: str, sql: str):
+        self.sql.put((normalize_question(question), fingerprint), sql)
+
+    def get_result(self, sql: str, data_version: int) -> Any:
+        return self.results.get((sql.strip(), data_version))
+
+    def put_result(self, sql: str, data_version: int, result: Any):
+        self.results.put((sql.strip(), data_version), result)
+
+    def clear(self):
+        self.sql.clear()
+        self.results.clear()
+
+    def stats(self) -> dict:
+        return {"sql": self.sql.stats(), "results": self.results.stats()}
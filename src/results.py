@@ -0,0 +1,81 @@
+import json
+from typing import Iterator
+
+import pandas as pd
+from sqlalchemy import text
+
+from src.db_pool import engine_pool
+from src.metrics import metrics
+
+
+def strip_sql(query: str) -> str:
+    """Drops the trailing semicolon, so the query can be wrapped as a subquery."""
+    return query.strip().rstrip(";").strip()
+
+
+def stream_query(query: str, db_url: str, params: dict = None, chunk_size: int = 1000) -> Iterator[pd.DataFrame]:
+    """Yields the result of `query` as DataFrames of at most `chunk_size` rows.
+
+    Rows come from a server-side cursor (a named cursor on Postgres), so only one
+    chunk is held in memory at a time, however large the result is.
+
+    Args:
+        query (str): SQL to run.
+        db_url (str): Connection url of the database.
+        params (dict, optional): Bound parameters of `query`.
+        chunk_size (int): Rows per yielded DataFrame.
+    """
+    with engine_pool.connect(db_url) as connection:
+        result = connection.execution_options(
+            stream_results=True, max_row_buffer=chunk_size
+        ).execute(text(query), params or {})
+        columns = list(result.keys())
+
+        rows = 0
+        for partition in result.partitions(chunk_size):
+            rows += len(partition)
+            yield pd.DataFrame(partition, columns=columns)
+        metrics.observe("sql_result_rows", rows, mode="stream")
+
+
+def stream_arrow(query: str, db_url: str, params: dict = None, chunk_size: int = 1000):
+    """Same as `stream_query`, as pyarrow RecordBatches."""
+    import pyarrow as pa
+
+    for chunk in stream_query(query, db_url, params=params, chunk_size=chunk_size):
+        yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+
+def paged_query(query: str, page: int, page_size: int) -> str:
+    """`query` limited to one page of rows, pages start at 0.
+
+    Pages are cut with LIMIT/OFFSET on the wrapped query, so only queries with
+    an ORDER BY give stable pages across reruns.
+    """
+    return (
+        f"SELECT * FROM ({strip_sql(query)}) AS paged_query "
+        f"LIMIT {int(page_size)} OFFSET {int(page) * int(page_size)}"
+    )
+
+
+def estimate_row_count(query: str, db_url: str) -> tuple:
+    """Number of rows `query` returns, without running it where possible.
+
+    On Postgres this is the planner's estimate from EXPLAIN, elsewhere the
+    query is counted.
+
+    Returns:
+        tuple: (row count, whether the count is exact)
+    """
+    query = strip_sql(query)
+    with engine_pool.connect(db_url) as connection:
+        if connection.dialect.name == "postgresql":
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query}")).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"]), False
+
+        count = connection.execute(
+            text(f"SELECT COUNT(*) FROM ({query}) AS counted_query")
+        ).scalar()
+        return int(count), True
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of an unsorted list, 0.0 when empty."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class BatchScheduler:
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20,
+        latency_window: int = 10000,
+    ) -> None:
+        """Collects concurrent requests into micro-batches for one model.
+
+        Callers `submit` single items and get a future back. A worker thread
+        waits for the first item, keeps collecting until `max_batch_size`
+        items are queued or `max_wait_ms` has passed, then runs them through
+        `run_batch` in one call.
+
+        Args:
+            run_batch (Callable): Maps a list of items to a list of results, in order.
+            max_batch_size (int): Max items per `run_batch` call.
+            max_wait_ms (float): Max time the first item of a batch waits for company.
+            latency_window (int): Number of recent request latencies kept for percentiles.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=latency_window)
+        self._batch_sizes = Counter()
+        self._requests = 0
+        self._lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, item: Any) -> Future:
+        """Queues one item, the future resolves to its result."""
+        if self._stopped.is_set():
+            raise RuntimeError("Scheduler has been shut down.")
+
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self) -> list:
+        # block for the first request, the wait window starts when it arrives
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            batch = self._collect()
+            if not batch:
+                continue
+
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                results = None
+
+            done = time.perf_counter()
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+                self._requests += len(batch)
+                self._latencies.extend(done - submitted for _, _, submitted in batch)
+
+            if results is not None:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        """Queue depth, batch size histogram and request latency percentiles."""
+        with self._lock:
+            latencies = list(self._latencies)
+            histogram = dict(sorted(self._batch_sizes.items()))
+            requests = self._requests
+
+        batches = sum(histogram.values())
+        return {
+            "queue_depth": self._queue.qsize(),
+            "requests": requests,
+            "batches": batches,
+            "mean_batch_size": requests / batches if batches else 0.0,
+            "batch_size_histogram": histogram,
+            "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Stops accepting requests, queued ones are still served."""
+        self._stopped.set()
+        if wait:
+            self._worker.join()
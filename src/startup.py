@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Any, Callable
+
+from src.metrics import metrics
+
+# first import of this module, close enough to process start for the UI
+PROCESS_START = time.perf_counter()
+
+_marked = {}
+_marked_lock = threading.Lock()
+
+
+class BackgroundLoader:
+    def __init__(self, factory: Callable[[], Any], name: str = "model") -> None:
+        """Runs a slow factory, e.g. a model load, on a daemon thread.
+
+        The page renders and stays interactive while the model loads, callers
+        that need it block in `get` until it is ready.
+
+        Args:
+            factory (Callable): Builds the object, called once.
+            name (str): Used in metrics and messages.
+        """
+        self.factory = factory
+        self.name = name
+
+        self.value = None
+        self.error = None
+        self.seconds = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        threading.Thread(target=self._load, daemon=True, name=f"load-{self.name}").start()
+        return self
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self.value = self.factory()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.seconds = time.perf_counter() - start
+            metrics.observe("model_load_seconds", self.seconds, model=self.name)
+            self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() and self.error is None
+
+    @property
+    def failed(self) -> bool:
+        return self._done.is_set() and self.error is not None
+
+    def get(self, timeout: float | None = None):
+        """The loaded object, starting the load if nobody did yet.
+
+        Raises:
+            TimeoutError: If it is not loaded within `timeout` seconds.
+            Exception: Whatever the factory raised.
+        """
+        self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.name} still loading after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def mark_ready(stage: str, budget: float | None = None) -> float:
+    """Records the seconds since process start at which `stage` was first reached.
+
+    Only the first call per stage and process counts, later reruns return the
+    recorded value again.
+
+    Args:
+        stage (str): Name of the milestone, e.g. "ui".
+        budget (float, optional): Seconds allowed, a warning is printed when exceeded.
+
+    Returns:
+        float: Cold start time of the stage in seconds.
+    """
+    elapsed = time.perf_counter() - PROCESS_START
+    with _marked_lock:
+        if stage in _marked:
+            return _marked[stage]
+        _marked[stage] = elapsed
+
+    metrics.observe("cold_start_seconds", elapsed, stage=stage)
+    if budget is not None and elapsed > budget:
+        print(f"Cold start of {stage} took {elapsed:.2f}s, over the {budget:.2f}s budget")
+    return elapsed
@@ -1,20 +1,38 @@
+import hashlib
 import pandas as pd
 from typing import Any, Iterable
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 
 from src.db_models import Table
+from src.db_pool import engine_pool
+from src.metrics import metrics
+
+# set on an extraction whose decoder was stopped in a repetition loop, the
+# output is kept for inspection but never cached or written to the database
+LOOPED_KEY = "_looped"
 
 
 def get_data_from_query(query, db_url, params=None):
-    engine = create_engine(db_url)
     query = text(query)
-    with engine.connect() as connection:
+    with engine_pool.connect(db_url) as connection, metrics.timer("sql_execute_seconds"):
         raw_conn = connection.connection
         data = pd.read_sql_query(str(query), raw_conn, params=params)
-    engine.dispose()
+    metrics.observe("sql_result_rows", len(data))
     return data
 
 
+def bytes_sha256(data: bytes) -> str:
+    """Hex sha256 of raw file bytes, used to recognise re-uploaded images."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_sha256(image) -> str:
+    """Hex sha256 of a decoded PIL image, for images that do not come from a file."""
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
 class PromptFormatterV1:
 
     def __init__(self, tables: Iterable[Table], db_type: str) -> None:
@@ -49,8 +67,8 @@ class PromptFormatterV1:
             create_tbl = f"CREATE TABLE {table_name}"
         return create_tbl
 
-    def __call__(self, question: str | None = None) -> str:
-
+    def prefix(self) -> str:
+        """Schema and instructions, the part of the prompt shared by every question."""
         temp = []
         for table in self.tables:
             temp.append(self.format(table))
@@ -58,8 +76,16 @@ class PromptFormatterV1:
         # add temp table info to the main prompt:
         main_prompt = "\n\n".join(temp)
 
+        return f"""{main_prompt}\n\n\n-- Using valid {self.db_type}, answer the following questions for the tables provided above.\n\n"""
+
+    def suffix(self, question: str | None = None) -> str:
+        """The question specific end of the prompt."""
         # sql prefix to start the generation
         sql_prefix = "SELECT"
 
+        return f"""-- {question}\n{sql_prefix}"""
+
+    @metrics.timed("prompt_format_seconds")
+    def __call__(self, question: str | None = None) -> str:
         # return the final prompt.
-        return f"""{main_prompt}\n\n\n-- Using valid {self.db_type}, answer the following questions for the tables provided above.\n\n-- {question}\n{sql_prefix}"""
+        return self.prefix() + self.suffix(question)
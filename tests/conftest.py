@@ -0,0 +1,16 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def donut(tmp_path_factory):
+    """DonutInference over a tiny random Donut, see benchmark.build_tiny_donut."""
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from benchmark import build_tiny_donut
+    from inference import DonutInference
+
+    folder = build_tiny_donut(str(tmp_path_factory.mktemp("donut")))
+    DonutInference._instances.pop(DonutInference, None)
+    model = DonutInference(model_pth=folder, device="cpu", early_exit=False)
+    yield model
+    DonutInference._instances.pop(DonutInference, None)
@@ -0,0 +1,43 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("sqlalchemy")
+
+import benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_main_smoke(tmp_path):
+    output = tmp_path / "results.json"
+    benchmark.main(
+        [
+            "--images", os.path.join(ROOT, "test_images"),
+            "--keys", os.path.join(ROOT, "data", "key"),
+            "--limit", "4",
+            "--batch-sizes", "1,2",
+            "--repeats", "1",
+            "--db-url", f"sqlite:///{tmp_path / 'bench.sqlite'}",
+            "--output", str(output),
+        ]
+    )
+
+    results = json.loads(output.read_text())
+    assert set(results) == {"environment", "startup", "extraction", "ingest", "query", "text_to_sql"}
+    assert results["extraction"]["2"]["images"] > 0
+    assert results["ingest"]["invoices"] + results["ingest"]["invalid_records"] == 4
+    assert results["ingest"]["push_many_failures"] == 0
+
+
+def test_bench_ingest_skips_malformed(tmp_path):
+    records = benchmark.load_records(os.path.join(ROOT, "data", "key"), limit=32)
+    records.append({"header": {"invoice_no": "broken"}, "items": None})
+
+    result = benchmark.bench_ingest(f"sqlite:///{tmp_path / 'ingest.sqlite'}", records)
+
+    assert result["invalid_records"] >= 1
+    assert result["invoices"] + result["invalid_records"] == len(records)
@@ -0,0 +1,30 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("pandas")
+
+from sqlalchemy import inspect, text
+
+from src.database_utils import InvoiceDatabase
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_reset_tables_upgrades_an_old_schema(tmp_path):
+    database = InvoiceDatabase(f"sqlite:///{tmp_path / 'old.sqlite'}")
+    with database.engine.begin() as connection:
+        # items as created before line numbers existed
+        connection.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY, invoice_no VARCHAR, item_desc TEXT)"))
+    database.create_tables()
+    assert "line_no" not in {c["name"] for c in inspect(database.engine).get_columns("items")}
+    before = database.data_version()
+
+    database.reset_tables()
+
+    assert "line_no" in {c["name"] for c in inspect(database.engine).get_columns("items")}
+    assert database.data_version() > before
+    with open(os.path.join(ROOT, "data", "key", sorted(os.listdir(os.path.join(ROOT, "data", "key")))[0])) as f:
+        assert database.push_many([json.load(f)]) == {}
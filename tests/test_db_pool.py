@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy import text
+
+from src.db_pool import EnginePool
+
+
+def test_every_checkout_is_timed(tmp_path):
+    pool = EnginePool()
+    url = f"sqlite:///{tmp_path / 'pool.sqlite'}"
+
+    with pool.connect(url) as connection:
+        connection.execute(text("SELECT 1"))
+    with pool.get_engine(url).connect() as connection:
+        connection.execute(text("SELECT 1"))
+    session = pool.session_factory(url)()
+    session.execute(text("SELECT 1"))
+    session.close()
+    pool.get_engine(url).dispose()
+    with pool.get_engine(url).connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+    stats = pool.stats(url)
+    assert stats["checkouts"] == stats["checkins"] == 4
+    assert stats["checked_out"] == 0
+    assert pool._metrics[url].waits == 4
+    assert stats["wait_seconds_mean"] == pytest.approx(stats["wait_seconds_total"] / 4, abs=1e-4)
+    pool.dispose()
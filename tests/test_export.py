@@ -0,0 +1,52 @@
+import csv
+import json
+import os
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("pandas")
+
+from src.database_utils import InvoiceDatabase
+from src.export import export_query
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = InvoiceDatabase(f"sqlite:///{tmp_path / 'export.sqlite'}")
+    database.create_tables()
+
+    key_dir = os.path.join(ROOT, "data", "key")
+    records = []
+    for name in sorted(os.listdir(key_dir))[:20]:
+        with open(os.path.join(key_dir, name)) as f:
+            records.append(json.load(f))
+    database.push_many(records)
+    return database
+
+
+@pytest.mark.parametrize("format", ["csv", "jsonl"])
+def test_export_query_streams_every_row(tmp_path, database, format):
+    sql = "SELECT invoice_no, item_desc, item_gross_worth FROM items ORDER BY invoice_no, line_no;"
+    path = tmp_path / f"items.{format}"
+
+    rows = export_query(sql, database.uri, str(path), chunk_size=7)
+
+    with open(path) as f:
+        if format == "csv":
+            written = list(csv.DictReader(f))
+        else:
+            written = [json.loads(line) for line in f]
+    assert rows == len(written) > 7
+    assert list(written[0]) == ["invoice_no", "item_desc", "item_gross_worth"]
+
+
+def test_export_query_parquet(tmp_path, database):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "summary.parquet"
+
+    rows = export_query("SELECT * FROM summary", database.uri, str(path), chunk_size=3)
+
+    assert pq.read_table(path).num_rows == rows > 3
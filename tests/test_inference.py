@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from src.decoding import InvoiceStoppingCriteria, LengthStats
+from src.utils import LOOPED_KEY
+
+
+class DictCache:
+    enabled = True
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, image_hash, model_id, params):
+        return self.entries.get((image_hash, params["max_length"]))
+
+    def put(self, image_hash, model_id, params, result):
+        self.entries[(image_hash, params["max_length"])] = result
+
+
+def test_adaptive_cap_reruns_truncated_rows(donut):
+    torch.manual_seed(0)
+    pixel_values = torch.randn(2, 3, 160, 128)
+
+    donut.length_stats = None
+    donut.cache = None
+    expected = donut.generate(pixel_values)
+
+    # a cap far below what the stand-in model generates, every row hits it
+    donut.length_stats = LengthStats(min_samples=1, floor=1, margin=1.0)
+    donut.length_stats.observe([2], max_length=64)
+    donut.cache = DictCache()
+
+    actual = donut.generate(pixel_values, image_hashes=["a", "b"])
+
+    assert actual == expected
+    full_length = donut.model.decoder.config.max_position_embeddings
+    assert set(donut.cache.entries) == {("a", full_length), ("b", full_length)}
+    assert donut.length_stats.as_dict()["max_length_seen"] > 2
+
+
+def test_stopping_criteria_flags_looped_rows():
+    criteria = InvoiceStoppingCriteria(end_token_id=9, prompt_length=1, min_span=8, pad_token_id=0)
+    input_ids = torch.tensor(
+        [
+            [1] + [5, 6] * 6,  # stuck repeating "5 6"
+            [1] + list(range(10, 21)) + [9],  # closed the invoice
+            [1] + list(range(10, 22)),  # still going
+        ]
+    )
+
+    done = criteria(input_ids, scores=None)
+
+    assert done.tolist() == [True, True, False]
+    assert criteria.looped.tolist() == [True, False, False]
+
+
+def test_looped_rows_are_marked_and_not_cached(donut, monkeypatch):
+    torch.manual_seed(0)
+    pixel_values = torch.randn(2, 3, 160, 128)
+    donut.length_stats = None
+    donut.cache = DictCache()
+
+    generate = donut._generate
+
+    def first_row_loops(*args):
+        sequences, lengths, _ = generate(*args)
+        return sequences, lengths, [True] + [False] * (len(lengths) - 1)
+
+    monkeypatch.setattr(donut, "_generate", first_row_loops)
+    results = donut.generate(pixel_values, image_hashes=["a", "b"])
+
+    assert results[0][LOOPED_KEY] is True
+    assert LOOPED_KEY not in results[1]
+    assert [key[0] for key in donut.cache.entries] == ["b"]
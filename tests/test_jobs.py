@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("pandas")
+
+from src.database_utils import InvoiceDatabase
+from src.jobs import JobQueue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeExtractor:
+    """Model server client stand-in, returns a fixed invoice per image."""
+
+    def __init__(self):
+        with open(os.path.join(ROOT, "data", "key", sorted(os.listdir(os.path.join(ROOT, "data", "key")))[0])) as f:
+            self.record = json.load(f)
+        self.calls = 0
+
+    def cache_lookup(self, image_hash):
+        return None
+
+    def extract(self, contents, image_hashes=None):
+        outputs = []
+        for _ in contents:
+            self.calls += 1
+            record = json.loads(json.dumps(self.record))
+            record["header"]["invoice_no"] = f"fake-{self.calls}"
+            outputs.append(record)
+        return outputs
+
+
+def wait_finished(queue, batch_id, timeout=30):
+    deadline = time.time() + timeout
+    while not queue.is_finished(batch_id):
+        assert time.time() < deadline, queue.summary(batch_id)
+        time.sleep(0.05)
+
+
+def test_same_path_twice_finishes(tmp_path):
+    database = InvoiceDatabase(f"sqlite:///{tmp_path / 'jobs.sqlite'}")
+    database.create_tables()
+
+    image = tmp_path / "invoice.jpg"
+    source = os.path.join(ROOT, "test_images", sorted(os.listdir(os.path.join(ROOT, "test_images")))[0])
+    shutil.copy(source, image)
+
+    queue = JobQueue(database, model_factory=FakeExtractor, poll_interval=0.05)
+    queue.start()
+    try:
+        batch_id = queue.enqueue([str(image), str(image)])
+        wait_finished(queue, batch_id)
+    finally:
+        queue.stop()
+
+    # the second copy has the same content, it is skipped rather than lost
+    assert queue.summary(batch_id) == {"done": 1, "skipped": 1}
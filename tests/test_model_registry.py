@@ -0,0 +1,43 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from benchmark import build_tiny_causal_lm, build_tiny_donut
+from src.model_registry import ModelRegistry
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(root=str(tmp_path / "registry"), offline=True)
+
+
+@pytest.mark.parametrize("mmap_weights", [True, False])
+def test_load_donut_save_pretrained(tmp_path, registry, mmap_weights):
+    from transformers import VisionEncoderDecoderModel
+
+    folder = build_tiny_donut(str(tmp_path / "donut"))
+    expected = VisionEncoderDecoderModel.from_pretrained(folder).eval()
+
+    model = registry.load(folder, VisionEncoderDecoderModel, mmap_weights=mmap_weights)
+
+    # save_pretrained leaves the tied lm_head out of the file, it must share the embeddings again
+    decoder = model.decoder
+    assert decoder.lm_head.weight.data_ptr() == decoder.get_input_embeddings().weight.data_ptr()
+    assert not any(param.is_meta for param in model.parameters())
+
+    actual_state = model.state_dict()
+    for key, value in expected.state_dict().items():
+        torch.testing.assert_close(actual_state[key], value, msg=key)
+
+
+def test_load_causal_lm(tmp_path, registry):
+    from transformers import AutoModelForCausalLM
+
+    folder = build_tiny_causal_lm(str(tmp_path / "lm"))
+    model = registry.load(folder, AutoModelForCausalLM, mmap_weights=True)
+
+    assert model.lm_head.weight.data_ptr() == model.get_input_embeddings().weight.data_ptr()
+    input_ids = torch.tensor([[1, 2, 3]])
+    expected = AutoModelForCausalLM.from_pretrained(folder).eval()
+    torch.testing.assert_close(model(input_ids).logits, expected(input_ids).logits)
@@ -0,0 +1,87 @@
+import threading
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("sqlalchemy")
+
+from PIL import Image
+
+from model_server import ModelServer
+from src.model_client import ModelClient
+
+
+class StubExtractor:
+    """Records the size of every batch it is asked to parse."""
+
+    def __init__(self):
+        self.batches = []
+
+    def infer_batch(self, images, batch_size=8, image_hashes=None):
+        self.batches.append(len(images))
+        return [
+            {"width": image.width, "image_hash": image_hash}
+            for image, image_hash in zip(images, image_hashes)
+        ]
+
+
+class StubTextModel:
+    def generate_text(self, input_text, max_length=500, prefix=None):
+        return f"{prefix or ''}SELECT '{input_text}' LIMIT {max_length}"
+
+
+def png(width):
+    buffer = BytesIO()
+    Image.new("RGB", (width, 8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(max_wait_ms=20):
+        server = ModelServer(StubExtractor(), StubTextModel(), port=0, batch_size=4, max_wait_ms=max_wait_ms)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_extract_and_sql(start_server):
+    server = start_server()
+    client = ModelClient(server.url)
+    assert client.health()
+
+    results = client.extract([png(16)])
+    assert results[0]["width"] == 16 and len(results[0]["image_hash"]) == 64
+
+    assert client.generate_text("total", max_length=20, prefix="-- ") == "-- SELECT 'total' LIMIT 20"
+    assert client.stats()["extract"]["requests"] == 1
+
+
+def test_concurrent_extracts_share_a_batch(start_server):
+    # a long wait, so concurrent requests can only be split by a full batch
+    server = start_server(max_wait_ms=5000)
+    client = ModelClient(server.url)
+    results = [None] * 4
+
+    def extract(idx):
+        results[idx] = client.extract([png(10 + idx)])[0]
+
+    threads = [threading.Thread(target=extract, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # each request gets its own image back
+    assert [result["width"] for result in results] == [10, 11, 12, 13]
+    assert server.extractor.batches == [4]
+    stats = client.stats()["extract"]
+    assert stats["requests"] == 4
+    assert stats["batch_size_histogram"] == {"4": 1}
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("sqlalchemy")
+
+from src.database_utils import InvoiceDatabase
+from src.pipeline import IngestPipeline
+from src.utils import LOOPED_KEY
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_model_stage_goes_through_scheduler(tmp_path, donut):
+    database = InvoiceDatabase(f"sqlite:///{tmp_path / 'pipeline.sqlite'}")
+    database.create_tables()
+    donut.cache = None
+    donut.length_stats = None
+
+    image_dir = os.path.join(ROOT, "test_images")
+    paths = [os.path.join(image_dir, name) for name in sorted(os.listdir(image_dir))[:3]]
+
+    before = donut.scheduler.stats()["requests"]
+    results = list(IngestPipeline(inference_model=donut, database=database, batch_size=2).run(paths))
+
+    assert sorted(result.index for result in results) == [0, 1, 2]
+    assert not any(result.error and "inference failed" in result.error for result in results)
+    assert donut.scheduler.stats()["requests"] - before == 3
+
+
+class LoopingExtractor:
+    """Model server client stand-in whose decoder always loops."""
+
+    def cache_lookup(self, image_hash):
+        return None
+
+    def extract(self, contents, image_hashes=None):
+        return [{"header": {"invoice_no": "1 1 1 1"}, LOOPED_KEY: True} for _ in contents]
+
+
+def test_looped_outputs_are_failed_not_written(tmp_path):
+    database = InvoiceDatabase(f"sqlite:///{tmp_path / 'looped.sqlite'}")
+    database.create_tables()
+
+    image_dir = os.path.join(ROOT, "test_images")
+    paths = [os.path.join(image_dir, sorted(os.listdir(image_dir))[0])]
+    pipeline = IngestPipeline(inference_model=LoopingExtractor(), database=database)
+    results = list(pipeline.run(paths))
+
+    assert len(results) == 1 and "looped" in results[0].error
+    assert pipeline.report()["model"]["errors"] == 1
+
+    # a second run reports only itself
+    list(pipeline.run(paths))
+    assert pipeline.report()["model"]["errors"] == 1
+    assert list(database.fetch_records()) == []
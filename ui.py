@@ -1,15 +1,24 @@
+import math
 import os
+import time
 import uuid
-import torch
+import pandas as pd
 import streamlit as st
-from PIL import Image
-from stqdm import stqdm
-from inference import DonutInference
 
+# torch and transformers are only imported by the model loaders below
+from src.startup import BackgroundLoader, mark_ready
+from src.model_registry import warm_up
 from src.db_connector import DatabaseAgent
-from src.database_utils import InvoiceDatabase
-from src.llm import TextInference, SQLExtractor
-from src.utils import PromptFormatterV1, get_data_from_query
+from src.database_utils import InvoiceDatabase, INTERNAL_TABLES
+from src.llm import SQLExtractor
+from src.jobs import JobQueue
+from src.extraction_cache import ExtractionCache
+from src.query_cache import QueryCache, schema_fingerprint
+from src.model_client import ModelClient
+from src.utils import PromptFormatterV1
+from src.analytics import AnalyticsMirror, QueryRouter
+from src.results import estimate_row_count, paged_query
+from src.export import export_query
 
 st.set_page_config(layout="wide")
 st.markdown(
@@ -22,21 +31,123 @@ st.markdown(
 """,
     unsafe_allow_html=True,
 )
-from config import connection_url, database_info_dict, model_name_30
+from config import (
+    connection_url,
+    database_info_dict,
+    model_name_30,
+    extraction_batch_size,
+    ingest_decode_workers,
+    ingest_commit_every,
+    extraction_cache_enabled,
+    extraction_cache_path,
+    extraction_cache_max_entries,
+    model_server_url,
+    cpu_quantize,
+    cpu_quantize_encoder,
+    torch_num_threads,
+    torch_num_interop_threads,
+    pixel_cache_dir,
+    ingest_job_workers,
+    ingest_poll_interval,
+    startup_budget_seconds,
+    text_model_name,
+    text_prefix_cache_size,
+    text_prompt_lookup_tokens,
+    model_warmup,
+    analytics_mirror_enabled,
+    analytics_mirror_dir,
+    analytics_sync_interval,
+    analytics_max_lag_versions,
+    result_page_size,
+)
+
+def load_inference_model():
+    if model_server_url:
+        # models stay resident in model_server.py, the page is a thin client
+        return ModelClient(model_server_url)
+
+    import torch
+    from inference import DonutInference
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = DonutInference(
+        model_pth=model_name_30,
+        device=device,
+        quantize=cpu_quantize and device == "cpu",
+        quantize_encoder=cpu_quantize_encoder,
+        num_threads=torch_num_threads,
+        num_interop_threads=torch_num_interop_threads,
+        cache=ExtractionCache(
+            path=extraction_cache_path,
+            max_entries=extraction_cache_max_entries,
+            enabled=extraction_cache_enabled,
+        ),
+    )
+    return warm_up(model) if model_warmup else model
+
+
+def load_text_model():
+    if model_server_url:
+        return ModelClient(model_server_url)
+
+    from src.llm import TextInference
+
+    model = TextInference(
+        model_name=text_model_name,
+        prefix_cache_size=text_prefix_cache_size,
+        prompt_lookup_num_tokens=text_prompt_lookup_tokens,
+    )
+    return warm_up(model) if model_warmup else model
+
+
+@st.cache_resource
+def get_model_loaders():
+    # models load on background threads while the page is already usable
+    return {
+        "extraction": BackgroundLoader(load_inference_model, name="extraction").start(),
+        "text": BackgroundLoader(load_text_model, name="text").start(),
+    }
 
-with st.spinner("Please wait loading model.."):
+
+@st.cache_resource
+def create_tables():
+    # once per process, not on every rerun
+    InvoiceDatabase(uri=connection_url).create_tables()
+
+
+@st.cache_resource
+def get_job_queue():
+    # one background worker pool per process, it outlives reruns and refreshes
+    job_queue = JobQueue(
+        database=InvoiceDatabase(uri=connection_url),
+        model_factory=get_model_loaders()["extraction"].get,
+        workers=ingest_job_workers,
+        decode_workers=ingest_decode_workers,
+        batch_size=extraction_batch_size,
+        commit_every=ingest_commit_every,
+        pixel_cache_dir=pixel_cache_dir,
+    )
+    job_queue.start()
+    return job_queue
+
+
+with st.spinner("Please wait connecting to the database.."):
     try:
-        inference_model = DonutInference(
-            model_pth=model_name_30,
-            device="cuda" if torch.cuda.is_available() else "cpu",
-        )
         database_object = InvoiceDatabase(uri=connection_url)
-        database_object.create_tables()
+        create_tables()
         db_agent = DatabaseAgent(**database_info_dict)
+        model_loaders = get_model_loaders()
+        job_queue = get_job_queue()
     except Exception as e:
-        st.error(f"Error loading model or database: {e}")
+        st.error(f"Error loading database: {e}")
         st.stop()
 
+for loader in model_loaders.values():
+    if loader.failed:
+        st.error(f"Error loading the {loader.name} model: {loader.error}")
+    elif not loader.ready:
+        st.caption(f"The {loader.name} model is loading in the background..")
+
 if "folder_path" not in st.session_state:
     st.session_state.folder_path = ""
 
@@ -44,6 +155,34 @@ if "conversion_done" not in st.session_state:
     st.session_state.conversion_done = False
 
 
+@st.cache_resource
+def get_query_cache():
+    # shared by every session and kept across reruns
+    return QueryCache()
+
+
+query_cache = get_query_cache()
+
+
+@st.cache_resource
+def get_query_router():
+    # the optional duckdb mirror answers selects while it is fresh enough
+    mirror = None
+    if analytics_mirror_enabled:
+        mirror = AnalyticsMirror(
+            InvoiceDatabase(uri=connection_url), root=analytics_mirror_dir
+        ).start(interval=analytics_sync_interval)
+
+    return QueryRouter(
+        db_url=db_agent.conn_str,  # get the connection string from sql agent.
+        mirror=mirror,
+        max_lag_versions=analytics_max_lag_versions,
+    )
+
+
+query_router = get_query_router()
+
+
 def create_session_folder():
     session_id = str(uuid.uuid4())
     folder_path = os.path.join("uploaded_images", session_id)
@@ -53,10 +192,23 @@ def create_session_folder():
 
 
 def save_uploaded_images(uploaded_files, folder_path):
+    """Writes the uploaded images to `folder_path`, returns the saved paths."""
+    paths = []
     for file in uploaded_files:
         if file.type in ["image/png", "image/jpeg"]:
-            img = Image.open(file)
-            img.save(os.path.join(folder_path, file.name))
+            # files picked from different folders may share a name, keep them all
+            stem, ext = os.path.splitext(file.name)
+            path = os.path.join(folder_path, file.name)
+            copy = 1
+            while os.path.exists(path):
+                path = os.path.join(folder_path, f"{stem}_{copy}{ext}")
+                copy += 1
+
+            # keep the original bytes, re-encoding would cost a decode and an encode
+            with open(path, "wb") as f:
+                f.write(file.getvalue())
+            paths.append(path)
+    return paths
 
 
 col1, col2 = st.columns([1, 3])
@@ -79,53 +231,63 @@ with col1:
     if uploaded_files:
         if st.button("Upload"):
             st.session_state.folder_path = create_session_folder()
-            save_uploaded_images(uploaded_files, st.session_state.folder_path)
-
-            try:
-                st.markdown(
-                    """
-                <div style="text-align: left;">
-                <span style="font-size: 14px; color: Red;">
-                Processing the uploaded invoices:
-                </span>
-                </div>
-                """,
-                    unsafe_allow_html=True,
-                )
-                for image_file in stqdm(
-                    os.listdir(st.session_state.folder_path),
-                    desc="Processing your Invoice.📰",
-                ):
-                    # read image from pth
-                    img_pth = os.path.join(
-                        str(st.session_state.folder_path), str(image_file)
-                    )
+            paths = save_uploaded_images(uploaded_files, st.session_state.folder_path)
 
-                    # convert image
-                    img = Image.open(img_pth)
+            # processing happens in the background, the page only polls job state
+            st.session_state.batch_id = job_queue.enqueue(paths)
+            st.session_state.conversion_done = False
+            st.experimental_set_query_params(batch=st.session_state.batch_id)
+
+    # the batch id is kept in the url as well, so a browser refresh finds it again
+    batch_id = st.session_state.get("batch_id") or st.experimental_get_query_params().get(
+        "batch", [None]
+    )[0]
+
+    if batch_id:
+        st.markdown(
+            """
+        <div style="text-align: left;">
+        <span style="font-size: 14px; color: Red;">
+        Processing the uploaded invoices:
+        </span>
+        </div>
+        """,
+            unsafe_allow_html=True,
+        )
+        counts = job_queue.summary(batch_id)
+        total = sum(counts.values())
+        finished = sum(counts.get(status, 0) for status in ("done", "skipped", "failed"))
 
-                    # perform inference on image
-                    dict_file = inference_model(image=img)
+        st.progress(finished / total if total else 1.0)
+        st.write(counts)
 
-                    print(dict_file)
+        jobs = job_queue.status(batch_id)
+        with st.expander("See processing details:"):
+            st.dataframe(pd.DataFrame(jobs), use_container_width=True)
 
-                    # log the images to database
-                    database_object.push_data(data=dict_file)
-                st.success("Invoices pushed to database.")
-                st.session_state.conversion_done = True
-            except Exception as e:
-                st.error(f"Error processing invoices: {e}")
+        if job_queue.is_finished(batch_id):
+            if counts.get("skipped"):
+                st.info(f"{counts['skipped']} invoice(s) were already uploaded, skipped.")
+            for job in jobs:
+                if job["status"] == "failed":
+                    st.warning(f"{job['filename']}: {job['error']}")
+            st.success("Invoices pushed to database.")
+            st.session_state.conversion_done = True
+        else:
+            # poll again shortly, any widget interaction interrupts the wait
+            time.sleep(ingest_poll_interval)
+            st.experimental_rerun()
 
 
 with col2:
     if st.session_state.conversion_done:
 
-        del inference_model
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-
         with st.expander("See Database Schema:"):
-            tables = db_agent.grab_table_names()
+            tables = [
+                table
+                for table in db_agent.grab_table_names()
+                if table not in INTERNAL_TABLES
+            ]
             schema = db_agent.grab_table_schema(tables=tables)
             st.write(schema)
 
@@ -135,21 +297,79 @@ with col2:
             formatter = PromptFormatterV1(tables=schema, db_type="PostgreSQL")
             prompt = formatter(question=text)
 
-            inference_llm = TextInference()
-            output = inference_llm.generate_text(input_text=prompt, max_length=1024)
+            # repeat questions against the same schema reuse the generated sql
+            fingerprint = schema_fingerprint(schema)
+            sql = query_cache.get_sql(text, fingerprint)
+
+            if sql is None:
+                with st.spinner("Waiting for the text model.."):
+                    inference_llm = model_loaders["text"].get()
+                # the schema part of the prompt is encoded once and reused
+                output = inference_llm.generate_text(
+                    input_text=prompt, max_length=1024, prefix=formatter.prefix()
+                )
+
+                extractor = SQLExtractor(text=output)
+                sql = extractor.extract_select_commands()[-1]
+                query_cache.put_sql(text, fingerprint, sql)
+
+            # kept across reruns, paging through the result reruns the page
+            st.session_state.sql = sql
+            st.session_state.prompt = prompt
+            st.session_state.result_page = 1
 
-            extractor = SQLExtractor(text=output)
-            sql = extractor.extract_select_commands()[-1]
+        sql = st.session_state.get("sql")
+        if sql:
+            with st.expander("Prompt and SQL"):
+                st.write(st.session_state.prompt)
+                st.write(sql)
 
-            if sql:
-                with st.expander("Prompt and SQL"):
-                    st.write(prompt)
-                    st.write(sql)
+            # only one page of rows is fetched and held, however large the result
+            data_version = database_object.data_version()
+            count_key = f"{sql}\n-- row count"
+            row_count = query_cache.get_result(count_key, data_version)
+            if row_count is None:
+                row_count = estimate_row_count(sql, db_url=db_agent.conn_str)
+                query_cache.put_result(count_key, data_version, row_count)
+            total, exact = row_count
 
-            # execute the sql
-            result_df = get_data_from_query(
-                query=sql,
-                db_url=db_agent.conn_str,  # get the connection string from sql agent.
+            pages = max(1, math.ceil(total / result_page_size))
+            page = st.number_input(
+                f"Page, {'' if exact else 'about '}{total} rows in {pages} page(s)",
+                min_value=1,
+                max_value=pages if exact else None,
+                step=1,
+                key="result_page",
             )
 
+            # execute the sql, unless the data has not changed since the last run
+            page_sql = paged_query(sql, page=page - 1, page_size=result_page_size)
+            result_df = query_cache.get_result(page_sql, data_version)
+
+            if result_df is None:
+                result_df, backend, lag = query_router.query(page_sql)
+                if lag is not None:
+                    st.caption(
+                        f"Answered from the analytics mirror, "
+                        f"{lag['versions_behind']} write(s) behind, "
+                        f"synced {lag['seconds_since_sync']}s ago."
+                    )
+                query_cache.put_result(page_sql, data_version, result_df)
+
             st.dataframe(result_df, use_container_width=True)
+
+            # the whole result is streamed to a file chunk by chunk, never held at once
+            if st.button("Export all rows as CSV"):
+                os.makedirs("exports", exist_ok=True)
+                export_path = os.path.join("exports", f"{uuid.uuid4()}.csv")
+                with st.spinner("Exporting.."):
+                    export_query(sql, db_url=db_agent.conn_str, path=export_path)
+                st.session_state.export = (sql, export_path)
+
+            export = st.session_state.get("export")
+            if export and export[0] == sql:
+                with open(export[1], "rb") as f:
+                    st.download_button("Download CSV", f, file_name="result.csv", mime="text/csv")
+
+# seconds from process start to the first rendered page, model loads excluded
+mark_ready("ui", budget=startup_budget_seconds)